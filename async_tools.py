@@ -0,0 +1,208 @@
+import asyncio
+import threading
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+import requests
+
+from distance_handling import geocode_async, GEOCODER_BREAKER, GEOCODER_URL
+from metrics import observe_upstream
+from moltin_tools import DEFAULT_TIMEOUTS
+from resilience import call_with_retries_async, CircuitBreaker, http_error
+
+
+class AsyncRuntime:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='asyncio', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def blocking(self, async_client, service='moltin'):
+        return BlockingClient(self, async_client, service)
+
+
+class BlockingClient:
+    def __init__(self, runtime, async_client, service):
+        self._runtime = runtime
+        self._async_client = async_client
+        self._service = service
+
+    def __getattr__(self, name):
+        method = getattr(self._async_client, name)
+
+        def call(*args, **kwargs):
+            with observe_upstream(self._service, name):
+                return self._runtime.run(method(*args, **kwargs))
+        return call
+
+
+async def convert_client_errors(coroutine):
+    try:
+        return await coroutine
+    except asyncio.TimeoutError as error:
+        raise requests.exceptions.Timeout(error) from error
+    except aiohttp.ClientError as error:
+        raise requests.exceptions.ConnectionError(error) from error
+
+
+def create_session(pool_size=100, timeout=10):
+    connector = aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+class AsyncGeocoder:
+    def __init__(self, apikey, pool_size=20, timeout=10, url=GEOCODER_URL, breaker=GEOCODER_BREAKER,
+                 attempts=2, deadline=6):
+        self.apikey = apikey
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.breaker = breaker
+        self.attempts = attempts
+        self.deadline = deadline
+        self._session = None
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    async def geocode(self, address):
+        if self._session is None:
+            self._session = create_session(self.pool_size, self.timeout)
+        return await call_with_retries_async(
+            lambda: convert_client_errors(geocode_async(self._session, self.apikey, address, self.url)),
+            self.attempts,
+            self.breaker,
+            deadline=self.deadline,
+        )
+
+
+class AsyncMoltinClient:
+    def __init__(self, base_url, token_provider, pool_size=100, timeout=10, currency='RUB', timeouts=None,
+                 breaker=None, read_attempts=3, read_deadline=10):
+        self.base_url = base_url
+        self.token_provider = token_provider
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.currency = currency
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker('moltin')
+        self.read_attempts = read_attempts
+        self.read_deadline = read_deadline
+        self._session = None
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    def get_timeout(self, method, path):
+        path = urlsplit(path).path
+        for (timeout_method, prefix), (connect_timeout, read_timeout) in self.timeouts.items():
+            if method == timeout_method and path.startswith(prefix):
+                return aiohttp.ClientTimeout(total=connect_timeout + read_timeout, sock_connect=connect_timeout)
+        return aiohttp.ClientTimeout(total=self.timeout)
+
+    async def _request(self, method, path, headers=None, **kwargs):
+        if self._session is None:
+            self._session = create_session(self.pool_size, self.timeout)
+        kwargs.setdefault('timeout', self.get_timeout(method, path))
+        return await call_with_retries_async(
+            lambda: convert_client_errors(self._send(method, path, headers, kwargs)),
+            self.read_attempts if method == 'GET' else 1,
+            self.breaker,
+            deadline=self.read_deadline,
+        )
+
+    async def _send(self, method, path, headers, kwargs):
+        url = urljoin(self.base_url, path)
+        loop = asyncio.get_running_loop()
+        token = await loop.run_in_executor(None, getattr, self.token_provider, 'token')
+        for attempt in range(2):
+            request_headers = {'Authorization': f'Bearer {token}', **(headers or {})}
+            async with self._session.request(method, url, headers=request_headers, **kwargs) as response:
+                if response.status == 401 and not attempt:
+                    token = await loop.run_in_executor(None, self.token_provider.refresh, token)
+                    continue
+                if response.status >= 400:
+                    raise http_error(response.status, f'{method} {path}')
+                return await response.json(content_type=None)
+
+    async def get_products(self):
+        return [product async for product in self.iter_products()]
+
+    def iter_products(self, page_size=100):
+        return self.iter_pages('/v2/products', page_size)
+
+    async def iter_pages(self, path, page_size=100):
+        params = {'page[limit]': page_size, 'page[offset]': 0}
+        while path:
+            payload = await self._request('GET', path, params=params)
+            for record in payload['data']:
+                yield record
+            links = payload.get('links') or {}
+            if not links.get('next') or links['next'] == links.get('current') or len(payload['data']) < page_size:
+                return
+            path, params = links['next'], None
+
+    async def get_product(self, product_id):
+        return (await self._request('GET', f'/v2/products/{product_id}'))['data']
+
+    async def fetch_image(self, image_id):
+        return (await self._request('GET', f'/v2/files/{image_id}'))['data']['link']['href']
+
+    async def add_product_to_cart(self, product_id, quantity, user_id):
+        payload = {
+            'data': {
+                'type': 'cart_item',
+                'id': product_id,
+                'quantity': int(quantity),
+            }
+        }
+        return await self._request(
+            'POST',
+            f'/v2/carts/{user_id}/items',
+            headers={'X-MOLTIN-CURRENCY': self.currency},
+            json=payload,
+        )
+
+    async def get_cart(self, user_id):
+        return await self._request('GET', f'/v2/carts/{user_id}/items')
+
+    async def remove_item_from_cart(self, user_id, product_id):
+        return await self._request('DELETE', f'/v2/carts/{user_id}/items/{product_id}')
+
+    async def create_customer(self, user_id):
+        payload = {
+            'data': {
+                'type': 'customer',
+                'name': user_id,
+                'email': f'{user_id}@plug.com',
+            }
+        }
+        return (await self._request('POST', '/v2/customers', json=payload))['data']['id']
+
+    async def get_pizzerias(self):
+        return [pizzeria async for pizzeria in self.iter_pizzerias()]
+
+    def iter_pizzerias(self, page_size=100):
+        return self.iter_pages('/v2/flows/pizzeria/entries', page_size)
+
+    async def save_customer_address(self, lat, lon, customer_id):
+        payload = {
+            'data': {
+                'type': 'entry',
+                'lat': lat,
+                'lon': lon,
+                'customer_id': customer_id,
+            },
+        }
+        return (await self._request('POST', '/v2/flows/customer_address/entries', json=payload))['data']
@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import add_fake_arguments, create_fake_services, get_fake_point
+from benchmarks.harness import BotHarness, create_bench_redis
+from benchmarks.report import find_regressions, print_table, save_results, Timings
+from benchmarks.updates import UpdateFactory
+from json_stream import iter_records
+from load_menu_addresses import BulkLoader
+from moltin_sync import plan_menu_sync, SyncCheckpoint
+from moltin_tools import MoltinClient, MoltinTokenProvider
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MENU_PATH = os.path.join(REPO_DIR, 'menu.json')
+ADDRESSES_PATH = os.path.join(REPO_DIR, 'addresses.json')
+FIRST_CHAT_ID = 100000
+DELIVERYMAN_ID = 1
+TOTAL_AMOUNT = 100000
+EXPECTED_CALLS = {'precheckout_callback': 'answerPreCheckoutQuery'}
+
+
+class RecordingClient:
+    def __init__(self, client):
+        self._client = client
+        self.timings = {}
+        self.phase = None
+
+    def start_phase(self, phase):
+        self.phase = phase
+        self.timings = {}
+
+    def finish_phase(self, elapsed):
+        for timings in self.timings.values():
+            timings.elapsed = elapsed
+        return [timings.summary() for timings in self.timings.values()]
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith('iter_') or name.endswith('_fields'):
+            return attribute
+        timings = self.timings.setdefault(name, Timings(f'{self.phase}.{name}'))
+
+        def call(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception:
+                timings.record(time.perf_counter() - started_at, failed=True)
+                raise
+            timings.record(time.perf_counter() - started_at)
+            return result
+        return call
+
+
+def make_menu(records):
+    menu = list(iter_records(MENU_PATH))
+    return [{**menu[number % len(menu)], 'id': number + 1} for number in range(records)]
+
+
+def make_addresses(records):
+    addresses = list(iter_records(ADDRESSES_PATH))
+    return [
+        {**addresses[number % len(addresses)], 'alias': f'{addresses[number % len(addresses)]["alias"]} #{number}'}
+        for number in range(records)
+    ]
+
+
+def get_handler_scenarios(harness, services, updates):
+    States = harness.tg_bot.States
+    Transitions = harness.tg_bot.Transitions
+    product_ids = list(services.moltin.products)
+    addresses = [address['address']['full'] for address in iter_records(ADDRESSES_PATH)]
+
+    def in_state(state, make_update):
+        def prepare(chat_id, number):
+            harness.set_state(chat_id, state)
+            return make_update(chat_id, number)
+        return prepare
+
+    def with_order(state, make_update):
+        def prepare(chat_id, number):
+            harness.user_data(chat_id)['order_info'] = {
+                'coordinates': get_fake_point(str(number)),
+                'delivery_cost': 100,
+                'deliveryman_id': DELIVERYMAN_ID,
+            }
+            return in_state(state, make_update)(chat_id, number)
+        return prepare
+
+    def remove_from_cart(chat_id, number):
+        harness.set_state(chat_id, States.handle_cart)
+        item_id = services.moltin.put_in_cart(str(chat_id), product_ids[number % len(product_ids)])
+        return updates.callback(chat_id, f'del|{item_id}')
+
+    return {
+        'start': in_state(None, lambda chat_id, number: updates.command(chat_id, 'start')),
+        'start.page': in_state(
+            States.handle_menu,
+            lambda chat_id, number: updates.callback(chat_id, f'{Transitions.menu}|{number % 2}'),
+        ),
+        'handle_menu': in_state(
+            States.handle_menu,
+            lambda chat_id, number: updates.callback(chat_id, product_ids[number % len(product_ids)]),
+        ),
+        'handle_description': in_state(
+            States.handle_description,
+            lambda chat_id, number: updates.callback(chat_id, f'1|{product_ids[number % len(product_ids)]}'),
+        ),
+        'handle_cart': in_state(
+            States.handle_description,
+            lambda chat_id, number: updates.callback(chat_id, str(Transitions.cart)),
+        ),
+        'handle_cart.remove': remove_from_cart,
+        'handle_order': in_state(
+            States.handle_cart,
+            lambda chat_id, number: updates.callback(chat_id, str(Transitions.order)),
+        ),
+        'handle_location.address': in_state(
+            States.waiting_coordinates,
+            lambda chat_id, number: updates.text(chat_id, addresses[number % len(addresses)]),
+        ),
+        'handle_location.point': in_state(
+            States.waiting_coordinates,
+            lambda chat_id, number: updates.location(chat_id, *get_fake_point(str(number))),
+        ),
+        'handle_delivery': with_order(
+            States.waiting_payment,
+            lambda chat_id, number: updates.callback(chat_id, str(Transitions.deliver)),
+        ),
+        'precheckout_callback': lambda chat_id, number: updates.pre_checkout(chat_id, TOTAL_AMOUNT),
+        'successful_payment_callback': with_order(
+            States.handle_user_reply,
+            lambda chat_id, number: updates.successful_payment(chat_id, TOTAL_AMOUNT),
+        ),
+    }
+
+
+def seed_services(services):
+    services.moltin.reset()
+    services.moltin.seed_menu(iter_records(MENU_PATH))
+    services.moltin.seed_pizzerias(iter_records(ADDRESSES_PATH), DELIVERYMAN_ID)
+
+
+def bench_handlers(services, args):
+    seed_services(services)
+    harness = BotHarness(
+        services,
+        create_bench_redis(args.redis_url),
+        ASYNC_IO=args.async_io,
+        TG_RATE_LIMIT=0,
+        TG_CHAT_RATE_LIMIT=0,
+    )
+    updates = UpdateFactory()
+    rows = []
+    for name, prepare in get_handler_scenarios(harness, services, updates).items():
+        if args.handler and name not in args.handler:
+            continue
+        timings = Timings(f'handler.{name}')
+        expected_call = EXPECTED_CALLS.get(name)
+        for number in range(args.warmup + args.iterations):
+            payload = prepare(FIRST_CHAT_ID + number % args.chats, number)
+            calls = services.telegram.calls[expected_call]
+            duration, error = harness.process(payload)
+            if error is None and expected_call and services.telegram.calls[expected_call] == calls:
+                error = LookupError(f'{name} не вызвал {expected_call}')
+            if number >= args.warmup:
+                timings.record(duration, failed=error is not None)
+                timings.elapsed += duration
+        rows.append(timings.summary())
+    return rows
+
+
+def bench_loader(services, args):
+    services.moltin.reset()
+    token_provider = MoltinTokenProvider(services.moltin.url, 'fake', 'fake')
+    client = RecordingClient(MoltinClient(services.moltin.url, token_provider, pool_size=args.concurrency * 2))
+    loader = BulkLoader(client, concurrency=args.concurrency)
+    menu = make_menu(args.records)
+    rows = []
+
+    def run_phase(phase, function, *function_args):
+        client.start_phase(phase)
+        started_at = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*function_args)
+        rows.extend(client.finish_phase(time.perf_counter() - started_at))
+
+    run_phase('load_menu', loader.load_menu, menu)
+    run_phase('load_addresses', loader.load_addresses, make_addresses(args.records))
+
+    changed_menu = [
+        {**pizza, 'price': pizza['price'] + 10} if number % 10 == 0 else pizza
+        for number, pizza in enumerate(menu)
+    ]
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint = SyncCheckpoint(os.path.join(checkpoint_dir, 'checkpoint'))
+
+        def sync_menu():
+            checkpoint.start('bench', plan_menu_sync(client, changed_menu))
+            loader.run_sync(checkpoint)
+            checkpoint.finish()
+        run_phase('sync_menu', sync_menu)
+
+    token_provider.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарки обработчиков бота и загрузчика меню')
+    parser.add_argument('--suite', choices=['all', 'handlers', 'loader'], default='all', help='что измерять')
+    parser.add_argument('--handler', action='append', help='измерять только этот обработчик(можно несколько раз)')
+    parser.add_argument('--iterations', type=int, default=200, help='число измерений на обработчик')
+    parser.add_argument('--warmup', type=int, default=20, help='число прогревочных вызовов на обработчик')
+    parser.add_argument('--chats', type=int, default=50, help='число разных чатов')
+    parser.add_argument('--records', type=int, default=500, help='число записей для загрузчика')
+    parser.add_argument('--concurrency', type=int, default=8, help='параллельность загрузчика')
+    add_fake_arguments(parser)
+    parser.add_argument('--async-io', action='store_true', help='включить ASYNC_IO')
+    parser.add_argument('--redis-url', help='адрес настоящего Redis(по умолчанию fakeredis)')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    parser.add_argument('--baseline', help='сравнить с сохранёнными результатами')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение относительно baseline')
+    parser.add_argument('--verbose', action='store_true', help='показывать логи бота')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.disable(logging.CRITICAL)
+
+    services = create_fake_services(args)
+    rows = []
+    with services:
+        if args.suite in ('all', 'handlers'):
+            rows += bench_handlers(services, args)
+        if args.suite in ('all', 'loader'):
+            rows += bench_loader(services, args)
+
+    print_table(rows)
+    if args.json:
+        save_results(args.json, rows)
+    if args.baseline:
+        regressions = find_regressions(rows, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Регрессия: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
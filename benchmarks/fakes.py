@@ -0,0 +1,500 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MOSCOW_BOUNDS = ((55.57, 37.36), (55.91, 37.84))
+
+
+class FakeRequest:
+    def __init__(self, method, path, params, headers, body):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        if 'json' not in self.headers.get('Content-Type', ''):
+            return {}
+        return json.loads(self.body or b'{}')
+
+    def form_field(self, name):
+        match = re.search(rb'name="%s"\r\n\r\n(.*?)\r\n' % name.encode(), self.body, re.S)
+        return match.group(1).decode() if match else None
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        request = FakeRequest(method, url.path, dict(parse_qsl(url.query)), self.headers, body)
+        status, payload = self.server.dispatch(request)
+        content = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, error_status=500, seed=None, listen='127.0.0.1', port=0):
+        super().__init__((listen, port), FakeRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = Counter()
+        self.errors = Counter()
+        self.routes = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def route(self, method, pattern, handler):
+        self.routes.append((method, re.compile(pattern), handler))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, request):
+        for method, pattern, handler in self.routes:
+            match = pattern.fullmatch(request.path)
+            if method == request.method and match:
+                break
+        else:
+            return 404, self.error_payload(404)
+
+        operation = self.get_operation(handler, match)
+        with self._lock:
+            self.calls[operation] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors[operation] += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self.error_status, self.error_payload(self.error_status)
+        with self._lock:
+            result = handler(request, **match.groupdict())
+        return result if isinstance(result, tuple) else (200, result)
+
+    def get_operation(self, handler, match):
+        return handler.__name__
+
+    def error_payload(self, status):
+        return {'errors': [{'status': status, 'title': 'Fake error'}]}
+
+
+class FakeMoltin(FakeServer):
+    def __init__(self, currency='RUB', **kwargs):
+        super().__init__(**kwargs)
+        self.currency = currency
+        self.reset()
+        self.route('POST', r'/oauth/access_token', self.access_token)
+        self.route('GET', r'/v2/products', self.list_products)
+        self.route('POST', r'/v2/products', self.create_product)
+        self.route('GET', r'/v2/products/(?P<product_id>[^/]+)', self.get_product)
+        self.route('PUT', r'/v2/products/(?P<product_id>[^/]+)', self.update_product)
+        self.route('DELETE', r'/v2/products/(?P<product_id>[^/]+)', self.delete_product)
+        self.route('POST', r'/v2/products/(?P<product_id>[^/]+)/relationships/main-image', self.set_main_image)
+        self.route('POST', r'/v2/files', self.create_file)
+        self.route('GET', r'/v2/files/(?P<file_id>[^/]+)', self.get_file)
+        self.route('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.get_cart)
+        self.route('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.add_cart_item)
+        self.route('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.remove_cart_item)
+        self.route('POST', r'/v2/customers', self.create_customer)
+        self.route('GET', r'/v2/customers/(?P<customer_id>[^/]+)', self.get_customer)
+        self.route('PUT', r'/v2/customers/(?P<customer_id>[^/]+)', self.update_customer)
+        self.route('POST', r'/v2/flows', self.create_flow)
+        self.route('POST', r'/v2/fields', self.create_field)
+        self.route('GET', r'/v2/flows/(?P<slug>[^/]+)/entries', self.list_entries)
+        self.route('POST', r'/v2/flows/(?P<slug>[^/]+)/entries', self.create_entry)
+        self.route('PUT', r'/v2/flows/(?P<slug>[^/]+)/entries/(?P<entry_id>[^/]+)', self.update_entry)
+        self.route('DELETE', r'/v2/flows/(?P<slug>[^/]+)/entries/(?P<entry_id>[^/]+)', self.delete_entry)
+
+    def reset(self):
+        with self._lock:
+            self.products = {}
+            self.files = {}
+            self.carts = defaultdict(list)
+            self.customers = {}
+            self.flows = {}
+            self.entries = defaultdict(dict)
+
+    def seed_menu(self, menu):
+        with self._lock:
+            for pizza in menu:
+                product = self._store_product(self._product_fields(pizza))
+                image = self._store_file(pizza['product_image']['url'])
+                product['relationships'] = {'main_image': {'data': {'type': 'main_image', 'id': image['id']}}}
+        return list(self.products.values())
+
+    def seed_pizzerias(self, addresses, deliveryman_id=1):
+        with self._lock:
+            for address in addresses:
+                self._store_entry('pizzeria', {
+                    'Address': address['address']['full'],
+                    'Alias': address['alias'],
+                    'Longitude': str(address['coordinates']['lon']),
+                    'Latitude': str(address['coordinates']['lat']),
+                    'deliveryman': deliveryman_id,
+                })
+        return list(self.entries['pizzeria'].values())
+
+    def put_in_cart(self, cart_id, product_id, quantity=1):
+        with self._lock:
+            return self._add_to_cart(cart_id, product_id, quantity)['id']
+
+    def access_token(self, request):
+        return {'access_token': uuid.uuid4().hex, 'expires': int(time.time()) + 3600, 'token_type': 'Bearer'}
+
+    def list_products(self, request):
+        return self._page(request, list(self.products.values()))
+
+    def get_product(self, request, product_id):
+        if product_id not in self.products:
+            return 404, self.error_payload(404)
+        return {'data': self.products[product_id]}
+
+    def create_product(self, request):
+        return 201, {'data': self._store_product(request.json()['data'])}
+
+    def update_product(self, request, product_id):
+        if product_id not in self.products:
+            return 404, self.error_payload(404)
+        self.products[product_id].update(request.json()['data'])
+        return {'data': self.products[product_id]}
+
+    def delete_product(self, request, product_id):
+        if self.products.pop(product_id, None) is None:
+            return 404, self.error_payload(404)
+        return 204, {}
+
+    def set_main_image(self, request, product_id):
+        if product_id not in self.products:
+            return 404, self.error_payload(404)
+        self.products[product_id]['relationships'] = {'main_image': {'data': request.json()['data']}}
+        return {'data': request.json()['data']}
+
+    def create_file(self, request):
+        return 201, {'data': self._store_file(request.form_field('file_location'))}
+
+    def get_file(self, request, file_id):
+        if file_id not in self.files:
+            return 404, self.error_payload(404)
+        return {'data': self.files[file_id]}
+
+    def get_cart(self, request, cart_id):
+        return self._cart(cart_id)
+
+    def add_cart_item(self, request, cart_id):
+        item = request.json()['data']
+        if item['id'] not in self.products:
+            return 404, self.error_payload(404)
+        self._add_to_cart(cart_id, item['id'], item['quantity'])
+        return 201, self._cart(cart_id)
+
+    def remove_cart_item(self, request, cart_id, item_id):
+        self.carts[cart_id] = [item for item in self.carts[cart_id] if item['id'] != item_id]
+        return self._cart(cart_id)
+
+    def create_customer(self, request):
+        customer = {'id': str(uuid.uuid4()), 'type': 'customer', **request.json()['data']}
+        self.customers[customer['id']] = customer
+        return 201, {'data': customer}
+
+    def get_customer(self, request, customer_id):
+        if customer_id not in self.customers:
+            return 404, self.error_payload(404)
+        return {'data': self.customers[customer_id]}
+
+    def update_customer(self, request, customer_id):
+        if customer_id not in self.customers:
+            return 404, self.error_payload(404)
+        self.customers[customer_id].update(request.json()['data'])
+        return {'data': self.customers[customer_id]}
+
+    def create_flow(self, request):
+        flow = {'id': str(uuid.uuid4()), **request.json()['data']}
+        self.flows[flow['slug']] = flow
+        return 201, {'data': flow}
+
+    def create_field(self, request):
+        return 201, {'data': {'id': str(uuid.uuid4()), **request.json()['data']}}
+
+    def list_entries(self, request, slug):
+        return self._page(request, list(self.entries[slug].values()))
+
+    def create_entry(self, request, slug):
+        return 201, {'data': self._store_entry(slug, request.json()['data'])}
+
+    def update_entry(self, request, slug, entry_id):
+        if entry_id not in self.entries[slug]:
+            return 404, self.error_payload(404)
+        self.entries[slug][entry_id].update(request.json()['data'])
+        return {'data': self.entries[slug][entry_id]}
+
+    def delete_entry(self, request, slug, entry_id):
+        if self.entries[slug].pop(entry_id, None) is None:
+            return 404, self.error_payload(404)
+        return 204, {}
+
+    def _product_fields(self, pizza):
+        return {
+            'type': 'product',
+            'name': pizza['name'],
+            'slug': f"pizza-{pizza['id']}",
+            'sku': str(pizza['id']),
+            'description': pizza['description'],
+            'price': [{'amount': pizza['price'], 'currency': self.currency, 'includes_tax': True}],
+            'status': 'live',
+        }
+
+    def _store_product(self, fields):
+        product = {**fields, 'id': str(uuid.uuid4())}
+        self.products[product['id']] = product
+        return product
+
+    def _store_file(self, link):
+        image = {'type': 'file', 'id': str(uuid.uuid4()), 'link': {'href': link}}
+        self.files[image['id']] = image
+        return image
+
+    def _store_entry(self, slug, fields):
+        entry = {**fields, 'id': str(uuid.uuid4())}
+        self.entries[slug][entry['id']] = entry
+        return entry
+
+    def _add_to_cart(self, cart_id, product_id, quantity):
+        product = self.products[product_id]
+        amount = product['price'][0]['amount']
+        for item in self.carts[cart_id]:
+            if item['product_id'] == product_id:
+                break
+        else:
+            item = {
+                'id': str(uuid.uuid4()),
+                'type': 'cart_item',
+                'product_id': product_id,
+                'name': product['name'],
+                'description': product['description'],
+                'sku': product['sku'],
+                'quantity': 0,
+                'unit_price': {'amount': amount, 'currency': self.currency},
+            }
+            self.carts[cart_id].append(item)
+        item['quantity'] += int(quantity)
+        item['value'] = {'amount': amount * item['quantity'], 'currency': self.currency}
+        return item
+
+    def _cart(self, cart_id):
+        items = self.carts[cart_id]
+        total = sum(item['value']['amount'] for item in items)
+        return {
+            'data': items,
+            'meta': {'display_price': {'with_tax': {'amount': total, 'currency': self.currency}}},
+        }
+
+    @staticmethod
+    def _page(request, records):
+        limit = int(request.params.get('page[limit]', 100))
+        offset = int(request.params.get('page[offset]', 0))
+        links = {'current': f'{request.path}?page[limit]={limit}&page[offset]={offset}'}
+        if offset + limit < len(records):
+            links['next'] = f'{request.path}?page[limit]={limit}&page[offset]={offset + limit}'
+        return {
+            'data': records[offset:offset + limit],
+            'links': links,
+            'meta': {'results': {'total': len(records)}},
+        }
+
+
+class FakeGeocoder(FakeServer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.route('GET', r'/1\.x/?', self.geocode)
+
+    def geocode(self, request):
+        address = request.params.get('geocode', '').strip()
+        members = []
+        if address and 'nowhere' not in address.lower():
+            lat, lon = get_fake_point(address)
+            members.append({'GeoObject': {'name': address, 'Point': {'pos': f'{lon:.6f} {lat:.6f}'}}})
+        return {'response': {'GeoObjectCollection': {'featureMember': members}}}
+
+    def error_payload(self, status):
+        return {'statusCode': status, 'error': 'Fake error', 'message': 'Fake error'}
+
+
+class FakeTelegram(FakeServer):
+    def __init__(self, retry_after=1, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+        self.answered_queries = set()
+        self._message_ids = Counter()
+        self.route('POST', r'/bot(?P<token>[^/]+)/(?P<method>\w+)', self.call)
+        self.route('GET', r'/bot(?P<token>[^/]+)/(?P<method>\w+)', self.call)
+
+    def get_operation(self, handler, match):
+        return match['method']
+
+    def error_payload(self, status):
+        payload = {'ok': False, 'error_code': status, 'description': 'Fake error'}
+        if status == 429:
+            payload['parameters'] = {'retry_after': self.retry_after}
+        return payload
+
+    def call(self, request, token, method):
+        params = {**request.params, **request.json()}
+        bot_user = {'id': int(token.split(':')[0]), 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'getMe':
+            return {'ok': True, 'result': bot_user}
+        if method == 'getUpdates':
+            return {'ok': True, 'result': []}
+        if method == 'answerPreCheckoutQuery':
+            self.answered_queries.add(params['pre_checkout_query_id'])
+        if not method.startswith(('send', 'edit')):
+            return {'ok': True, 'result': True}
+        if 'inline_message_id' in params:
+            return {'ok': True, 'result': True}
+
+        chat_id = int(params['chat_id'])
+        if method.startswith('send'):
+            self._message_ids[chat_id] += 1
+        message = {
+            'message_id': int(params.get('message_id') or self._message_ids[chat_id]),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': bot_user,
+        }
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            message['reply_markup'] = json.loads(markup) if isinstance(markup, str) else markup
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        photo = params.get('photo')
+        if method == 'editMessageMedia':
+            media = params['media']
+            photo = (json.loads(media) if isinstance(media, str) else media).get('media')
+        if photo:
+            file_id = photo if photo.startswith('photo-') else f'photo-{zlib.crc32(photo.encode()):08x}'
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 800}]
+        if method == 'sendLocation':
+            message['location'] = {'latitude': float(params['latitude']), 'longitude': float(params['longitude'])}
+        if method == 'sendInvoice':
+            prices = json.loads(params['prices']) if isinstance(params['prices'], str) else params['prices']
+            message['invoice'] = {
+                'title': params['title'],
+                'description': params['description'],
+                'start_parameter': params.get('start_parameter', ''),
+                'currency': params['currency'],
+                'total_amount': sum(price['amount'] for price in prices),
+            }
+        return {'ok': True, 'result': message}
+
+
+def get_fake_point(address):
+    address_hash = zlib.crc32(address.encode())
+    (south, west), (north, east) = MOSCOW_BOUNDS
+    lat = south + (north - south) * (address_hash & 0xffff) / 0xffff
+    lon = west + (east - west) * (address_hash >> 16) / 0xffff
+    return lat, lon
+
+
+class FakeServices:
+    tg_token = '123456:fake-token'
+
+    def __init__(self, moltin_latency=0, geocoder_latency=0, telegram_latency=0, jitter=0, error_rate=0, seed=0):
+        self.moltin = FakeMoltin(latency=moltin_latency, jitter=jitter, error_rate=error_rate, seed=seed)
+        self.geocoder = FakeGeocoder(latency=geocoder_latency, jitter=jitter, error_rate=error_rate, seed=seed)
+        self.telegram = FakeTelegram(latency=telegram_latency, jitter=jitter, error_rate=error_rate, seed=seed)
+
+    def start(self):
+        for server in (self.moltin, self.geocoder, self.telegram):
+            server.start()
+        return self
+
+    def stop(self):
+        for server in (self.moltin, self.geocoder, self.telegram):
+            server.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def env(self):
+        return {
+            'TG_TOKEN': self.tg_token,
+            'TG_API_URL': f'{self.telegram.url}/bot',
+            'MOLTIN_BASE_URL': self.moltin.url,
+            'MOLTIN_CLIENT_ID': 'fake',
+            'MOLTIN_CLIENT_SECRET': 'fake',
+            'GEOCODER_API_KEY': 'fake',
+            'GEOCODER_URL': f'{self.geocoder.url}/1.x',
+            'PAYMENT_TOKEN': 'fake',
+        }
+
+
+def add_fake_arguments(parser):
+    parser.add_argument('--moltin-latency', type=float, default=20, help='задержка moltin, мс')
+    parser.add_argument('--geocoder-latency', type=float, default=50, help='задержка геокодера, мс')
+    parser.add_argument('--telegram-latency', type=float, default=30, help='задержка Telegram Bot API, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='случайная добавка к задержке, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля запросов, завершающихся ошибкой')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора ошибок и задержек')
+
+
+def create_fake_services(args):
+    return FakeServices(
+        moltin_latency=args.moltin_latency / 1000,
+        geocoder_latency=args.geocoder_latency / 1000,
+        telegram_latency=args.telegram_latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
@@ -0,0 +1,77 @@
+import importlib
+import os
+import threading
+import time
+
+import redis
+from environs import Env
+from telegram import Update
+from telegram.ext import Dispatcher, TypeHandler
+
+
+def create_bench_redis(redis_url=None):
+    if redis_url:
+        return redis.Redis.from_url(redis_url, decode_responses=True)
+    import fakeredis
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+class BotHarness:
+    def __init__(self, services, redis_db, persistence=None, **settings):
+        os.environ.update(services.env())
+        os.environ.update({name: str(value) for name, value in settings.items()})
+        self.services = services
+        self.tg_bot = importlib.import_module('tg-bot')
+        self.updater, self.conversation = self.tg_bot.build_updater(
+            Env(),
+            redis_db,
+            persistence,
+            persistent=persistence is not None,
+        )
+        self.dispatcher = self.updater.dispatcher
+        self.dispatcher.add_error_handler(self._remember_error)
+        self.dispatcher.add_handler(TypeHandler(Update, self._processed), group=1)
+        self.on_processed = None
+        self._local = threading.local()
+        self._thread = None
+
+    def process(self, payload):
+        update = Update.de_json(payload, self.dispatcher.bot)
+        started_at = time.perf_counter()
+        Dispatcher.process_update(self.dispatcher, update)
+        return time.perf_counter() - started_at, self._local.last_error
+
+    def submit(self, payload):
+        update = Update.de_json(payload, self.dispatcher.bot)
+        self.dispatcher.update_queue.put(update)
+        return update.update_id
+
+    def start(self):
+        self._thread = threading.Thread(target=self.dispatcher.start, name='dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+        self._thread.join()
+
+    def get_state(self, chat_id):
+        return self.conversation.conversations.get((chat_id, chat_id))
+
+    def set_state(self, chat_id, state):
+        if state is None:
+            self.conversation.conversations.pop((chat_id, chat_id), None)
+        else:
+            self.conversation.conversations[(chat_id, chat_id)] = state
+
+    def user_data(self, chat_id):
+        return self.dispatcher.user_data[chat_id]
+
+    def _remember_error(self, update, context):
+        self._local.error = context.error
+
+    def _processed(self, update, context):
+        error = getattr(self._local, 'error', None)
+        self._local.error = None
+        self._local.last_error = error
+        if self.on_processed:
+            self.on_processed(update, error)
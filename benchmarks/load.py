@@ -0,0 +1,372 @@
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from benchmarks.bench import ADDRESSES_PATH, FIRST_CHAT_ID, seed_services, TOTAL_AMOUNT
+from benchmarks.fakes import add_fake_arguments, create_fake_services, MOSCOW_BOUNDS
+from benchmarks.harness import BotHarness, create_bench_redis
+from benchmarks.report import percentile, print_table, save_results, Timings
+from benchmarks.updates import UpdateFactory
+from json_stream import iter_records
+
+
+class TrafficMix:
+    def __init__(self, think_time=2.0, max_items=3, browse_share=0.3, address_share=0.5, delivery_share=0.7,
+                 abandon_share=0.1):
+        self.think_time = think_time
+        self.max_items = max_items
+        self.browse_share = browse_share
+        self.address_share = address_share
+        self.delivery_share = delivery_share
+        self.abandon_share = abandon_share
+
+
+class Customer:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.steps = []
+        self.position = 0
+        self.funnel_started_at = 0
+        self.service_time = 0
+        self.abandoned = False
+
+
+class LevelStats:
+    def __init__(self, customers):
+        self.customers = customers
+        self.steps = Timings('steps')
+        self.funnels = Timings('funnels')
+        self.service_times = Timings('service')
+        self.abandoned = 0
+        self.failed = 0
+        self.started_at = time.perf_counter()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started_at
+        steps = sorted(self.steps.latencies)
+        funnels = sorted(self.funnels.latencies)
+        service_times = sorted(self.service_times.latencies)
+        return {
+            'customers': self.customers,
+            'updates_per_sec': len(steps) / elapsed,
+            'funnels_per_sec': len(funnels) / elapsed,
+            'step_p50_ms': percentile(steps, 0.5) * 1000,
+            'step_p99_ms': percentile(steps, 0.99) * 1000,
+            'funnel_p50_s': percentile(funnels, 0.5),
+            'funnel_p99_s': percentile(funnels, 0.99),
+            'service_p50_ms': percentile(service_times, 0.5) * 1000,
+            'errors': self.steps.errors,
+            'failed': self.failed,
+            'abandoned': self.abandoned,
+        }
+
+
+class LoadGenerator:
+    def __init__(self, harness, updates, product_ids, addresses, mix, seed=0):
+        self.harness = harness
+        self.updates = updates
+        self.product_ids = product_ids
+        self.addresses = addresses
+        self.mix = mix
+        self.customers = []
+        self.step_timings = {}
+        self.level = None
+        self._random = random.Random(seed)
+        self._events = []
+        self._sequence = itertools.count()
+        self._in_flight = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._driver = threading.Thread(target=self._drive, name='load-driver', daemon=True)
+        harness.on_processed = self._on_processed
+
+    def start(self):
+        self.harness.start()
+        self._driver.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._driver.join()
+        self.harness.stop()
+
+    def run_level(self, customers, duration):
+        with self._condition:
+            self.level = LevelStats(customers)
+            for _ in range(customers - len(self.customers)):
+                customer = Customer(FIRST_CHAT_ID + len(self.customers))
+                self.customers.append(customer)
+                self._schedule(customer, self._random.uniform(0, max(self.mix.think_time, 1)))
+        time.sleep(duration)
+        with self._condition:
+            return self.level.summary()
+
+    def plan_funnel(self, customer):
+        States = self.harness.tg_bot.States
+        Transitions = self.harness.tg_bot.Transitions
+        updates = self.updates
+        steps = []
+        if self.harness.get_state(customer.chat_id) is not None:
+            steps.append(('cancel', None, lambda chat_id: updates.command(chat_id, 'start')))
+        steps.append(('start', States.handle_menu, lambda chat_id: updates.command(chat_id, 'start')))
+        if self._random.random() < self.mix.browse_share:
+            steps.append((
+                'start.page',
+                States.handle_menu,
+                lambda chat_id: updates.callback(chat_id, f'{Transitions.menu}|1'),
+            ))
+        for number in range(self._random.randint(1, self.mix.max_items)):
+            product_id = self._random.choice(self.product_ids)
+            if number:
+                steps.append((
+                    'start',
+                    States.handle_menu,
+                    lambda chat_id: updates.callback(chat_id, str(Transitions.menu)),
+                ))
+            steps.append((
+                'handle_menu',
+                States.handle_description,
+                lambda chat_id, product_id=product_id: updates.callback(chat_id, product_id),
+            ))
+            steps.append((
+                'handle_description',
+                States.handle_description,
+                lambda chat_id, product_id=product_id: updates.callback(chat_id, f'1|{product_id}'),
+            ))
+        steps.append((
+            'handle_cart',
+            States.handle_cart,
+            lambda chat_id: updates.callback(chat_id, str(Transitions.cart)),
+        ))
+        steps.append((
+            'handle_order',
+            States.waiting_coordinates,
+            lambda chat_id: updates.callback(chat_id, str(Transitions.order)),
+        ))
+        if self._random.random() < self.mix.address_share:
+            address = self._random.choice(self.addresses)
+            steps.append((
+                'handle_location.address',
+                States.waiting_payment,
+                lambda chat_id: updates.text(chat_id, address),
+            ))
+        else:
+            (south, west), (north, east) = MOSCOW_BOUNDS
+            point = (self._random.uniform(south, north), self._random.uniform(west, east))
+            steps.append((
+                'handle_location.point',
+                States.waiting_payment,
+                lambda chat_id: updates.location(chat_id, *point),
+            ))
+        transition = Transitions.deliver if self._random.random() < self.mix.delivery_share else Transitions.pickup
+        steps.append((
+            'handle_delivery',
+            States.handle_user_reply,
+            lambda chat_id: updates.callback(chat_id, str(transition)),
+        ))
+        steps.append((
+            'precheckout_callback',
+            States.handle_user_reply,
+            lambda chat_id: updates.pre_checkout(chat_id, TOTAL_AMOUNT),
+        ))
+        steps.append((
+            'successful_payment_callback',
+            States.handle_menu,
+            lambda chat_id: updates.successful_payment(chat_id, TOTAL_AMOUNT),
+        ))
+
+        customer.abandoned = self._random.random() < self.mix.abandon_share
+        if customer.abandoned:
+            steps = steps[:self._random.randint(1, len(steps) - 1)]
+        customer.steps = steps
+        customer.position = 0
+        customer.service_time = 0
+        customer.funnel_started_at = time.perf_counter()
+
+    def _think_time(self):
+        if not self.mix.think_time:
+            return 0
+        return self._random.expovariate(1 / self.mix.think_time)
+
+    def _schedule(self, customer, delay):
+        heapq.heappush(self._events, (time.monotonic() + delay, next(self._sequence), customer))
+        self._condition.notify()
+
+    def _drive(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._events:
+                    self._condition.wait()
+                    continue
+                delay = self._events[0][0] - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                customer = heapq.heappop(self._events)[2]
+                if customer.position >= len(customer.steps):
+                    self.plan_funnel(customer)
+                name, _, make_update = customer.steps[customer.position]
+                update_id = self.harness.submit(make_update(customer.chat_id))
+                self._in_flight[update_id] = (customer, time.perf_counter())
+
+    def _on_processed(self, update, error):
+        finished_at = time.perf_counter()
+        with self._condition:
+            customer, sent_at = self._in_flight.pop(update.update_id, (None, None))
+            if customer is None:
+                return
+            name, expected_state, _ = customer.steps[customer.position]
+            latency = finished_at - sent_at
+            failed = error is not None or self.harness.get_state(customer.chat_id) != expected_state
+            if update.pre_checkout_query and not failed:
+                answered_queries = self.harness.services.telegram.answered_queries
+                failed = update.pre_checkout_query.id not in answered_queries
+                answered_queries.discard(update.pre_checkout_query.id)
+            if name not in self.step_timings:
+                self.step_timings[name] = Timings(f'funnel.{name}')
+            self.step_timings[name].record(latency, failed)
+            self.level.steps.record(latency, failed)
+            customer.service_time += latency
+            customer.position += 1
+            if failed:
+                self.level.failed += 1
+                customer.position = len(customer.steps)
+            elif customer.position == len(customer.steps):
+                if customer.abandoned:
+                    self.level.abandoned += 1
+                else:
+                    self.level.funnels.record(finished_at - customer.funnel_started_at)
+                    self.level.service_times.record(customer.service_time)
+            self._schedule(customer, self._think_time())
+
+
+def find_saturation(levels, latency_slo, min_scaling):
+    previous = None
+    for level in levels:
+        if level['step_p99_ms'] > latency_slo * 1000:
+            return level, f'p99 шага {level["step_p99_ms"]:.0f} мс превысил {latency_slo * 1000:.0f} мс'
+        if previous and previous['updates_per_sec']:
+            expected_gain = level['customers'] / previous['customers'] - 1
+            gain = level['updates_per_sec'] / previous['updates_per_sec'] - 1
+            if gain < expected_gain * min_scaling:
+                return level, f'пропускная способность выросла на {gain:.0%} при росте нагрузки на {expected_gain:.0%}'
+        previous = level
+    return None, None
+
+
+LEVEL_COLUMNS = [
+    ('customers', 10, ''),
+    ('updates_per_sec', 16, '.1f'),
+    ('funnels_per_sec', 16, '.2f'),
+    ('step_p50_ms', 12, '.1f'),
+    ('step_p99_ms', 12, '.1f'),
+    ('funnel_p50_s', 13, '.1f'),
+    ('funnel_p99_s', 13, '.1f'),
+    ('errors', 8, ''),
+    ('failed', 8, ''),
+    ('abandoned', 10, ''),
+]
+
+
+def print_levels(levels):
+    print(''.join(f'{name:>{width}}' for name, width, _ in LEVEL_COLUMNS))
+    for level in levels:
+        print(''.join(f'{level[name]:>{width}{spec}}' for name, width, spec in LEVEL_COLUMNS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест: синтетические покупатели проходят весь заказ')
+    parser.add_argument(
+        '--levels',
+        default='10,25,50,100,250,500,1000',
+        help='число одновременных покупателей на ступенях нагрузки',
+    )
+    parser.add_argument('--step-duration', type=float, default=30, help='длительность ступени, с')
+    parser.add_argument('--think-time', type=float, default=2, help='среднее время раздумий между нажатиями, с')
+    parser.add_argument('--max-items', type=int, default=3, help='максимум пицц в заказе')
+    parser.add_argument('--browse-share', type=float, default=0.3, help='доля покупателей, листающих меню')
+    parser.add_argument('--address-share', type=float, default=0.5, help='доля покупателей, вводящих адрес текстом')
+    parser.add_argument('--delivery-share', type=float, default=0.7, help='доля заказов с доставкой')
+    parser.add_argument('--abandon-share', type=float, default=0.1, help='доля покупателей, бросающих заказ')
+    parser.add_argument('--latency-slo', type=float, default=1, help='допустимая p99 задержка шага, с')
+    parser.add_argument(
+        '--min-scaling',
+        type=float,
+        default=0.5,
+        help='минимальная доля линейного роста пропускной способности до насыщения',
+    )
+    parser.add_argument('--stop-at-saturation', action='store_true', help='остановиться на первой ступени насыщения')
+    parser.add_argument('--bot-threads', type=int, default=8, help='число потоков обработки обновлений')
+    parser.add_argument('--async-io', action='store_true', help='включить ASYNC_IO')
+    parser.add_argument('--redis-url', help='адрес настоящего Redis(по умолчанию fakeredis)')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    parser.add_argument('--verbose', action='store_true', help='показывать логи бота')
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.disable(logging.CRITICAL)
+
+    mix = TrafficMix(
+        think_time=args.think_time,
+        max_items=args.max_items,
+        browse_share=args.browse_share,
+        address_share=args.address_share,
+        delivery_share=args.delivery_share,
+        abandon_share=args.abandon_share,
+    )
+    levels = []
+    with create_fake_services(args) as services:
+        seed_services(services)
+        harness = BotHarness(
+            services,
+            create_bench_redis(args.redis_url),
+            ASYNC_IO=args.async_io,
+            BOT_THREADS=args.bot_threads,
+        )
+        generator = LoadGenerator(
+            harness,
+            UpdateFactory(),
+            list(services.moltin.products),
+            [address['address']['full'] for address in iter_records(ADDRESSES_PATH)],
+            mix,
+            seed=args.seed,
+        )
+        generator.start()
+        for customers in map(int, args.levels.split(',')):
+            level = generator.run_level(customers, args.step_duration)
+            levels.append(level)
+            print(
+                f'{customers} покупателей: {level["updates_per_sec"]:.1f} обновлений в секунду, '
+                f'p99 шага {level["step_p99_ms"]:.0f} мс'
+            )
+            if args.stop_at_saturation and find_saturation(levels, args.latency_slo, args.min_scaling)[0]:
+                break
+        generator.stop()
+
+    print()
+    print_levels(levels)
+    saturation, reason = find_saturation(levels, args.latency_slo, args.min_scaling)
+    if saturation:
+        print(f'Насыщение при {saturation["customers"]} покупателях: {reason}')
+    else:
+        print('Насыщение не достигнуто')
+    print()
+    rows = []
+    for timings in generator.step_timings.values():
+        timings.elapsed = sum(timings.latencies)
+        rows.append(timings.summary())
+    print_table(rows)
+    if args.json:
+        save_results(args.json, {'levels': levels, 'steps': rows})
+
+
+if __name__ == '__main__':
+    main()
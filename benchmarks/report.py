@@ -0,0 +1,80 @@
+import json
+import math
+import threading
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+class Timings:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def record(self, duration, failed=False):
+        with self._lock:
+            self.latencies.append(duration)
+            if failed:
+                self.errors += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'name': self.name,
+            'count': len(latencies),
+            'errors': self.errors,
+            'ops_per_sec': len(latencies) / self.elapsed if self.elapsed else 0,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p90_ms': percentile(latencies, 0.9) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0) * 1000,
+        }
+
+
+COLUMNS = [
+    ('name', '{:<36}'),
+    ('count', '{:>7}'),
+    ('errors', '{:>7}'),
+    ('ops_per_sec', '{:>10.1f}'),
+    ('p50_ms', '{:>9.2f}'),
+    ('p90_ms', '{:>9.2f}'),
+    ('p99_ms', '{:>9.2f}'),
+    ('max_ms', '{:>9.2f}'),
+]
+
+
+def print_table(rows):
+    header = ''.join(
+        fmt.replace('.1f', '').replace('.2f', '').format(name)
+        for name, fmt in COLUMNS
+    )
+    print(header)
+    for row in rows:
+        print(''.join(fmt.format(row[name]) for name, fmt in COLUMNS))
+
+
+def save_results(file_path, rows):
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(rows, file, ensure_ascii=False, indent=2)
+
+
+def find_regressions(rows, baseline_path, tolerance):
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = {row['name']: row for row in json.load(file)}
+    regressions = []
+    for row in rows:
+        previous = baseline.get(row['name'])
+        if not previous:
+            continue
+        if row['ops_per_sec'] < previous['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{row['name']}: ops/sec {previous['ops_per_sec']:.1f} -> {row['ops_per_sec']:.1f}")
+        if row['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{row['name']}: p99 {previous['p99_ms']:.2f} -> {row['p99_ms']:.2f} мс")
+    return regressions
@@ -0,0 +1,76 @@
+import time
+from itertools import count
+
+
+class UpdateFactory:
+    def __init__(self, bot_id=123456):
+        self.bot_user = {'id': bot_id, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        self._ids = count(1)
+
+    def message(self, chat_id, **fields):
+        update_id = next(self._ids)
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': self._user(chat_id),
+                **fields,
+            },
+        }
+
+    def command(self, chat_id, command):
+        text = f'/{command}'
+        return self.message(chat_id, text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}])
+
+    def text(self, chat_id, text):
+        return self.message(chat_id, text=text)
+
+    def location(self, chat_id, latitude, longitude):
+        return self.message(chat_id, location={'latitude': latitude, 'longitude': longitude})
+
+    def callback(self, chat_id, data, message_id=1):
+        update_id = next(self._ids)
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self._user(chat_id),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': self.bot_user,
+                    'text': 'Вкусная питса:',
+                },
+            },
+        }
+
+    def pre_checkout(self, chat_id, total_amount, payload='payment-for-pizza'):
+        update_id = next(self._ids)
+        return {
+            'update_id': update_id,
+            'pre_checkout_query': {
+                'id': str(update_id),
+                'from': self._user(chat_id),
+                'currency': 'RUB',
+                'total_amount': total_amount,
+                'invoice_payload': payload,
+            },
+        }
+
+    def successful_payment(self, chat_id, total_amount, payload='payment-for-pizza'):
+        return self.message(chat_id, successful_payment={
+            'currency': 'RUB',
+            'total_amount': total_amount,
+            'invoice_payload': payload,
+            'telegram_payment_charge_id': f'tg-{chat_id}',
+            'provider_payment_charge_id': f'provider-{chat_id}',
+        })
+
+    @staticmethod
+    def _user(chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'Покупатель'}
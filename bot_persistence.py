@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from sharding import get_slot, SLOT_COUNT
+
+logger = logging.getLogger(__name__)
+
+DELETED = object()
+
+
+class ShardedRedisPersistence(BasePersistence):
+    def __init__(self, redis_db, state_type, slot_count=SLOT_COUNT, load_all=True, prefix='bot:state',
+                 flush_interval=0.5):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.redis_db = redis_db
+        self.state_type = state_type
+        self.slot_count = slot_count
+        self.load_all = load_all
+        self.prefix = prefix
+        self._written = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if flush_interval:
+            threading.Thread(target=self._flush_loop, args=(flush_interval,), name='persistence', daemon=True).start()
+
+    def load_slot(self, slot, conversation_names):
+        user_data = self._load_hash(self._key(slot, 'user_data'))
+        chat_data = self._load_hash(self._key(slot, 'chat_data'))
+        conversations = {}
+        for name in conversation_names:
+            conversations_key = self._key(slot, f'conversations:{name}')
+            stored = self.redis_db.hgetall(conversations_key)
+            self._remember(conversations_key, stored)
+            conversations[name] = {
+                tuple(json.loads(key)): self._decode_state(state)
+                for key, state in stored.items()
+            }
+        return user_data, chat_data, conversations
+
+    def drop_slot(self, slot):
+        self.flush()
+        slot_prefix = self._key(slot, '')
+        with self._lock:
+            for written_key in [key for key in self._written if key[0].startswith(slot_prefix)]:
+                del self._written[written_key]
+
+    def get_user_data(self):
+        return self._load_all(0)
+
+    def get_chat_data(self):
+        return self._load_all(1)
+
+    def get_bot_data(self):
+        bot_data = self.redis_db.get(f'{self.prefix}:bot_data')
+        self._remember(f'{self.prefix}:bot_data', {None: bot_data} if bot_data else {})
+        return json.loads(bot_data) if bot_data else {}
+
+    def get_conversations(self, name):
+        conversations = {}
+        if self.load_all:
+            for slot in range(self.slot_count):
+                conversations.update(self.load_slot(slot, [name])[2][name])
+        return conversations
+
+    def update_conversation(self, name, key, new_state):
+        conversations_key = self._key(get_slot(key[0], self.slot_count), f'conversations:{name}')
+        value = DELETED if new_state is None else self._encode_state(new_state)
+        self._queue(conversations_key, json.dumps(key), value)
+
+    def update_user_data(self, user_id, data):
+        self._queue(self._key(get_slot(user_id, self.slot_count), 'user_data'), str(user_id), json.dumps(data))
+
+    def update_chat_data(self, chat_id, data):
+        self._queue(self._key(get_slot(chat_id, self.slot_count), 'chat_data'), str(chat_id), json.dumps(data))
+
+    def update_bot_data(self, data):
+        self._queue(f'{self.prefix}:bot_data', None, json.dumps(data))
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            flushed = {written_key: self._digest(value) for written_key, value in pending.items()}
+            previous = {written_key: self._written.get(written_key) for written_key in flushed}
+            self._written.update(flushed)
+        if not pending:
+            return
+        try:
+            with self.redis_db.pipeline(transaction=False) as pipe:
+                for (key, field), value in pending.items():
+                    if field is None:
+                        pipe.set(key, value)
+                    elif value is DELETED:
+                        pipe.hdel(key, field)
+                    else:
+                        pipe.hset(key, field, value)
+                pipe.execute()
+        except Exception:
+            logger.exception('Не удалось сохранить состояние бота')
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+                for written_key, digest in flushed.items():
+                    if self._written.get(written_key) != digest:
+                        continue
+                    if previous[written_key] is None:
+                        self._written.pop(written_key, None)
+                    else:
+                        self._written[written_key] = previous[written_key]
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _flush_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def _queue(self, key, field, value):
+        written_key = (key, field)
+        with self._lock:
+            if written_key in self._pending:
+                if self._pending[written_key] == value:
+                    return
+            elif self._written.get(written_key, self._digest(DELETED)) == self._digest(value):
+                return
+            self._pending[written_key] = value
+
+    def _remember(self, key, stored):
+        with self._lock:
+            for field, value in stored.items():
+                self._written[(key, field)] = self._digest(value)
+
+    @staticmethod
+    def _digest(value):
+        if value is DELETED:
+            return None
+        return hashlib.blake2b(value.encode(), digest_size=16).digest()
+
+    def _load_all(self, index):
+        data = defaultdict(dict)
+        if self.load_all:
+            for slot in range(self.slot_count):
+                data.update(self.load_slot(slot, [])[index])
+        return data
+
+    def _load_hash(self, key):
+        stored = self.redis_db.hgetall(key)
+        self._remember(key, stored)
+        return {int(field): json.loads(value) for field, value in stored.items()}
+
+    def _key(self, slot, name):
+        return f'{self.prefix}:{slot}:{name}'
+
+    def _encode_state(self, state):
+        if isinstance(state, self.state_type):
+            return json.dumps({'state': state.name})
+        return json.dumps(state)
+
+    def _decode_state(self, value):
+        state = json.loads(value)
+        if isinstance(state, dict):
+            return self.state_type[state['state']]
+        return state
@@ -0,0 +1,71 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class CartMirror:
+    def __init__(self, redis_db, moltin, reconcile_interval=300, ttl=7 * 24 * 3600, prefix='cart:'):
+        self.redis_db = redis_db
+        self.moltin = moltin
+        self.reconcile_interval = reconcile_interval
+        self.ttl = ttl
+        self.prefix = prefix
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cart-reconcile')
+
+    def get(self, user_id):
+        mirror = self.redis_db.hgetall(self._key(user_id))
+        if not mirror:
+            return self.reconcile(user_id)
+        if time.time() - float(mirror['synced_at']) > self.reconcile_interval:
+            self._executor.submit(self._reconcile_safely, user_id, mirror['version'])
+        return json.loads(mirror['cart'])
+
+    def add(self, user_id, product_id, quantity):
+        cart = self.moltin.add_product_to_cart(product_id, quantity, user_id)
+        self._store(user_id, cart)
+        return cart
+
+    def remove(self, user_id, item_id):
+        cart = self.moltin.remove_item_from_cart(user_id, item_id)
+        self._store(user_id, cart)
+        return cart
+
+    def reconcile(self, user_id, expected_version=None):
+        key = self._key(user_id)
+        if expected_version is None:
+            expected_version = self.redis_db.hget(key, 'version')
+        cart = self.moltin.get_cart(user_id)
+        with self.redis_db.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.hget(key, 'version') == expected_version:
+                    pipe.multi()
+                    self._write(pipe, key, cart)
+                    pipe.execute()
+            except redis.WatchError:
+                logger.debug('Корзина %s изменилась во время сверки', user_id)
+        return cart
+
+    def _reconcile_safely(self, user_id, expected_version):
+        try:
+            self.reconcile(user_id, expected_version)
+        except Exception:
+            logger.exception('Не удалось сверить корзину %s', user_id)
+
+    def _store(self, user_id, cart):
+        with self.redis_db.pipeline() as pipe:
+            self._write(pipe, self._key(user_id), cart)
+            pipe.execute()
+
+    def _write(self, pipe, key, cart):
+        pipe.hset(key, mapping={'cart': json.dumps(cart), 'synced_at': time.time()})
+        pipe.hincrby(key, 'version', 1)
+        pipe.expire(key, self.ttl)
+
+    def _key(self, user_id):
+        return f'{self.prefix}{user_id}'
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+CATALOG_INVALIDATE_CHANNEL = 'catalog:invalidate'
+
+
+class CatalogCache:
+    def __init__(self, moltin, ttl=600, max_entries=512, refresh_workers=2):
+        self.moltin = moltin
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._fallback = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='catalog')
+
+    def get_products(self):
+        return self._get(('products',), self.moltin.get_products)
+
+    def get_product(self, product_id):
+        return self._get(('product', product_id), lambda: self.moltin.get_product(product_id))
+
+    def fetch_image(self, image_id):
+        return self._get(('image', image_id), lambda: self.moltin.fetch_image(image_id))
+
+    def warm(self):
+        products = self._reload(('products',), self.moltin.get_products)
+        for product in products:
+            self._reload(('product', product['id']), lambda: self.moltin.get_product(product['id']))
+            main_image = product.get('relationships', {}).get('main_image')
+            if main_image:
+                image_id = main_image['data']['id']
+                self._reload(('image', image_id), lambda: self.moltin.fetch_image(image_id))
+
+    def export(self):
+        with self._lock:
+            return [[list(key), value] for key, (value, expires_at) in self._entries.items()]
+
+    def seed(self, entries):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in entries:
+                self._entries[tuple(key)] = (value, expires_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            for key, (value, expires_at) in self._entries.items():
+                self._keep_fallback(key, value)
+            self._entries.clear()
+        logger.info('Кэш каталога сброшен')
+        self.warm_in_background()
+
+    def warm_in_background(self):
+        return self._executor.submit(self._warm_safely)
+
+    def listen_invalidations(self, redis_db):
+        pubsub = redis_db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CATALOG_INVALIDATE_CHANNEL: lambda message: self.invalidate()})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _get(self, key, fetch):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                value, expires_at = entry
+                if expires_at <= now and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    self._executor.submit(self._refresh, key, fetch)
+                return value
+
+        try:
+            value = fetch()
+        except Exception:
+            with self._lock:
+                if key not in self._fallback:
+                    raise
+                value = self._fallback[key]
+            logger.warning('Каталог недоступен, отдаю сохранённые данные %s', key)
+            return value
+        self._store(key, value)
+        return value
+
+    def _reload(self, key, fetch):
+        value = fetch()
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        with self._lock:
+            self._fallback.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted_key, (evicted_value, expires_at) = self._entries.popitem(last=False)
+                self._keep_fallback(evicted_key, evicted_value)
+
+    def _keep_fallback(self, key, value):
+        self._fallback[key] = value
+        self._fallback.move_to_end(key)
+        while len(self._fallback) > self.max_entries:
+            self._fallback.popitem(last=False)
+
+    def _refresh(self, key, fetch):
+        try:
+            self._store(key, fetch())
+        except Exception as error:
+            logger.warning('Не удалось обновить кэш каталога %s, отдаю прежние данные: %s', key, error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _warm_safely(self):
+        try:
+            self.warm()
+        except Exception:
+            logger.exception('Не удалось прогреть кэш каталога')
+            return False
+        return True
+
+
+def publish_invalidation(redis_db):
+    redis_db.publish(CATALOG_INVALIDATE_CHANNEL, 'invalidate')
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import BOT_READY
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class CatalogSnapshot:
+    def __init__(self, catalog, locator, path=None, save_interval=600, retry_interval=30):
+        self.catalog = catalog
+        self.locator = locator
+        self.path = path
+        self.save_interval = save_interval
+        self.retry_interval = retry_interval
+        self.ready = threading.Event()
+        self._stop = threading.Event()
+        BOT_READY.set(0)
+
+    def load(self):
+        if not self.path:
+            return False
+        started_at = time.perf_counter()
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logger.exception('Не удалось прочитать снимок каталога %s', self.path)
+            return False
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning('Снимок каталога %s устарел, он будет перезаписан', self.path)
+            return False
+        self.catalog.seed(snapshot['catalog'])
+        self.locator.update(snapshot['pizzerias'])
+        logger.info(
+            'Загружен снимок каталога за %.0f мс, сохранён %s назад',
+            (time.perf_counter() - started_at) * 1000,
+            format_age(time.time() - snapshot['saved_at']),
+        )
+        return True
+
+    def save(self):
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+            'catalog': self.catalog.export(),
+            'pizzerias': self.locator.pizzerias,
+        }
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temporary_path, self.path)
+
+    def start(self):
+        threading.Thread(target=self._refresh, name='catalog-snapshot', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh(self):
+        while not self.catalog.warm_in_background().result():
+            if self._stop.wait(self.retry_interval):
+                return
+        while not self.locator.refreshed.wait(1):
+            if self._stop.is_set():
+                return
+        self.ready.set()
+        BOT_READY.set(1)
+        logger.info('Каталог и пиццерии загружены из moltin')
+        if not self.path:
+            return
+        while True:
+            try:
+                self.save()
+            except OSError:
+                logger.exception('Не удалось сохранить снимок каталога %s', self.path)
+            if self._stop.wait(self.save_interval):
+                return
+
+
+def format_age(seconds):
+    if seconds < 3600:
+        return f'{seconds / 60:.0f} мин'
+    return f'{seconds / 3600:.1f} ч'
@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+import warnings
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from metrics import HANDLER_ACTIVE_CHATS, HANDLER_QUEUE_DEPTH, HANDLER_QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+
+def get_serial_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatSerialExecutor:
+    def __init__(self, workers=8, max_pending=1000, name='handler'):
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._chats = {}
+        self._ready = queue.SimpleQueue()
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._work, name=f'{name}-{number}', daemon=True)
+            for number in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        with self._condition:
+            return sum(len(tasks) for tasks in self._chats.values())
+
+    def submit(self, key, function, *args):
+        self._slots.acquire()
+        with self._condition:
+            HANDLER_QUEUE_DEPTH.inc()
+            task = (function, args, time.perf_counter())
+            tasks = self._chats.get(key)
+            if tasks is None:
+                self._chats[key] = deque([task])
+                HANDLER_ACTIVE_CHATS.set(len(self._chats))
+                self._ready.put(key)
+            else:
+                tasks.append(task)
+
+    def drain(self, predicate=None, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not any(predicate is None or predicate(key) for key in self._chats),
+                timeout,
+            )
+
+    def shutdown(self):
+        self.drain()
+        for _ in self._threads:
+            self._ready.put(STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is STOP:
+                return
+            with self._condition:
+                function, args, queued_at = self._chats[key].popleft()
+            HANDLER_QUEUE_DEPTH.dec()
+            HANDLER_QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('Ошибка при обработке обновления чата %s', key)
+            finally:
+                self._slots.release()
+                with self._condition:
+                    if self._chats[key]:
+                        self._ready.put(key)
+                    else:
+                        del self._chats[key]
+                        HANDLER_ACTIVE_CHATS.set(len(self._chats))
+                        self._condition.notify_all()
+
+
+class ChatSerialDispatcher(Dispatcher):
+    def __init__(self, *args, executor, **kwargs):
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'Asynchronous callbacks can not be processed')
+            super().__init__(*args, **kwargs)
+        self.executor = executor
+
+    def process_update(self, update):
+        key = get_serial_key(update)
+        if key is None:
+            return super().process_update(update)
+        self.executor.submit(key, super().process_update, update)
+
+    def drain(self, predicate=None, timeout=None):
+        return self.executor.drain(predicate, timeout)
+
+    def stop(self):
+        super().stop()
+        self.executor.shutdown()
+        outbox = getattr(self.bot.request, 'outbox', None)
+        if outbox:
+            outbox.stop()
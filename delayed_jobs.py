@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = 'bot:jobs:due'
+DATA_KEY = 'bot:jobs:data'
+DONE_KEY = 'bot:jobs:done:{job_id}'
+FAILED_KEY = 'bot:jobs:failed'
+
+SCHEDULE_JOB = '''
+if redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+if redis.call('zadd', KEYS[1], 'NX', ARGV[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[3])
+return 1
+'''
+CLAIM_JOBS = '''
+local job_ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for _, job_id in ipairs(job_ids) do
+    local payload = redis.call('hget', KEYS[2], job_id)
+    if payload and redis.call('exists', ARGV[4] .. job_id) == 0 then
+        redis.call('zadd', KEYS[1], ARGV[1] + ARGV[2], job_id)
+        table.insert(claimed, job_id)
+        table.insert(claimed, payload)
+    else
+        redis.call('zrem', KEYS[1], job_id)
+        redis.call('hdel', KEYS[2], job_id)
+    end
+end
+return claimed
+'''
+
+
+class Job:
+    def __init__(self, job_id, name, args, attempts=0):
+        self.id = job_id
+        self.name = name
+        self.args = args
+        self.attempts = attempts
+
+    def dumps(self):
+        return json.dumps({'name': self.name, 'args': self.args, 'attempts': self.attempts})
+
+    @classmethod
+    def loads(cls, job_id, payload):
+        fields = json.loads(payload)
+        return cls(job_id, fields['name'], fields['args'], fields['attempts'])
+
+
+class DelayedJobs:
+    def __init__(self, redis_db, handlers=None, lease_ttl=60, batch_size=100, poll_interval=1,
+                 max_attempts=5, retry_delay=30, done_ttl=7 * 24 * 3600, worker_id=None):
+        self.redis_db = redis_db
+        self.handlers = dict(handlers or {})
+        self.lease_ttl = lease_ttl
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.done_ttl = done_ttl
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self._schedule = redis_db.register_script(SCHEDULE_JOB)
+        self._claim = redis_db.register_script(CLAIM_JOBS)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+    def schedule(self, name, delay, *args, key):
+        job = Job(key, name, list(args))
+        run_at = int((time.time() + delay) * 1000)
+        return bool(self._schedule(
+            keys=[DUE_KEY, DATA_KEY, DONE_KEY.format(job_id=key)],
+            args=[key, run_at, job.dumps()],
+        ))
+
+    def cancel(self, key):
+        with self.redis_db.pipeline() as pipe:
+            pipe.zrem(DUE_KEY, key)
+            pipe.hdel(DATA_KEY, key)
+            return bool(pipe.execute()[0])
+
+    def claim(self):
+        now = int(time.time() * 1000)
+        claimed = self._claim(
+            keys=[DUE_KEY, DATA_KEY],
+            args=[now, self.lease_ttl * 1000, self.batch_size, DONE_KEY.format(job_id='')],
+        )
+        return [Job.loads(job_id, payload) for job_id, payload in zip(claimed[::2], claimed[1::2])]
+
+    def run_pending(self):
+        jobs = self.claim()
+        for job in jobs:
+            self._run(job)
+        return len(jobs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name='delayed-jobs', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    def _work(self):
+        while not self._stop_event.is_set():
+            try:
+                claimed = self.run_pending()
+            except Exception:
+                logger.exception('Не удалось получить отложенные задачи')
+                claimed = 0
+            if claimed < self.batch_size:
+                self._stop_event.wait(self.poll_interval)
+
+    def _run(self, job):
+        handler = self.handlers.get(job.name)
+        try:
+            if handler is None:
+                raise LookupError(f'Неизвестная задача {job.name}')
+            handler(*job.args)
+        except Exception:
+            logger.exception('Ошибка при выполнении отложенной задачи %s', job.id)
+            self._retry(job)
+        else:
+            self._complete(job)
+
+    def _complete(self, job):
+        with self.redis_db.pipeline() as pipe:
+            pipe.zrem(DUE_KEY, job.id)
+            pipe.hdel(DATA_KEY, job.id)
+            pipe.set(DONE_KEY.format(job_id=job.id), self.worker_id, ex=self.done_ttl)
+            pipe.execute()
+
+    def _retry(self, job):
+        job.attempts += 1
+        with self.redis_db.pipeline() as pipe:
+            if job.attempts >= self.max_attempts:
+                pipe.zrem(DUE_KEY, job.id)
+                pipe.hdel(DATA_KEY, job.id)
+                pipe.rpush(FAILED_KEY, json.dumps({'id': job.id, 'name': job.name, 'args': job.args}))
+            else:
+                run_at = int((time.time() + self.retry_delay * 2 ** (job.attempts - 1)) * 1000)
+                pipe.zadd(DUE_KEY, {job.id: run_at}, xx=True)
+                pipe.hset(DATA_KEY, job.id, job.dumps())
+            pipe.execute()
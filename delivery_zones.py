@@ -0,0 +1,365 @@
+import argparse
+import base64
+import bisect
+import csv
+import json
+import logging
+import math
+import sys
+import zlib
+from array import array
+
+from environs import Env
+
+from distance_handling import EARTH_RADIUS_KM, GEODESIC_TOLERANCE, get_pizzerias_fingerprint
+from moltin_tools import MoltinClient, MoltinTokenProvider
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_TIERS = (
+    (0.5, 0),
+    (5.0, 100),
+    (20.0, 300),
+)
+PICKUP_ONLY = len(DELIVERY_TIERS)
+BOUNDARY = 0xFFFF
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def get_delivery_tier(distance_km):
+    return bisect.bisect_right([max_distance for max_distance, _ in DELIVERY_TIERS], distance_km)
+
+
+def get_delivery_cost(tier):
+    return DELIVERY_TIERS[tier][1] if tier < PICKUP_ONLY else None
+
+
+def get_cell_size(precision):
+    bits = precision * 5
+    return 180 / 2 ** (bits // 2), 360 / 2 ** (bits - bits // 2)
+
+
+def encode_geohash(lat, lon, precision):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bit, char, even = 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        char <<= 1
+        if value >= middle:
+            char |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            geohash.append(GEOHASH_ALPHABET[char])
+            bit, char = 0, 0
+    return ''.join(geohash)
+
+
+def vectorized_haversine_km(lat1, lon1, lat2, lon2):
+    import numpy as np
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def get_covered_cells(pizzeria_lats, pizzeria_lons, south, west, rows, cols, cell_height, cell_width, margin_km):
+    import numpy as np
+
+    margin_rows = math.ceil(margin_km / KM_PER_DEGREE / cell_height) + 1
+    covered = np.empty(0, dtype=np.int64)
+    pending = []
+    pending_size = 0
+    for lat, lon in zip(pizzeria_lats, pizzeria_lons):
+        widest_lat = min(abs(lat) + margin_km / KM_PER_DEGREE, 89)
+        margin_cols = math.ceil(margin_km / KM_PER_DEGREE / math.cos(math.radians(widest_lat)) / cell_width) + 1
+        row = math.floor((lat - south) / cell_height)
+        col = math.floor((lon - west) / cell_width)
+        cell_rows, cell_cols = np.meshgrid(
+            np.arange(max(row - margin_rows, 0), min(row + margin_rows + 1, rows)),
+            np.arange(max(col - margin_cols, 0), min(col + margin_cols + 1, cols)),
+            indexing='ij',
+        )
+        cell_rows, cell_cols = cell_rows.ravel(), cell_cols.ravel()
+        lats = south + (cell_rows + 0.5) * cell_height
+        lons = west + (cell_cols + 0.5) * cell_width
+        radius = vectorized_haversine_km(lat - cell_height, lon - cell_width, lat + cell_height, lon + cell_width) / 2
+        near = vectorized_haversine_km(lats, lons, lat, lon) <= margin_km + radius
+        pending.append(cell_rows[near] * cols + cell_cols[near])
+        pending_size += len(pending[-1])
+        if pending_size > max(len(covered), 1000000):
+            covered = np.unique(np.concatenate([covered, *pending]))
+            pending, pending_size = [], 0
+    return np.unique(np.concatenate([covered, *pending]))
+
+
+def build_zone_grid(pizzerias, precision=7, margin_km=None, chunk_size=20000):
+    import numpy as np
+
+    pizzerias = list(pizzerias)
+    margin_km = DELIVERY_TIERS[-1][0] if margin_km is None else margin_km
+    pizzeria_lats = np.array([float(pizzeria['Latitude']) for pizzeria in pizzerias])
+    pizzeria_lons = np.array([float(pizzeria['Longitude']) for pizzeria in pizzerias])
+    cell_height, cell_width = get_cell_size(precision)
+
+    margin_lat = margin_km / KM_PER_DEGREE
+    max_lat = min(np.abs(pizzeria_lats).max() + margin_lat, 89)
+    margin_lon = margin_lat / math.cos(math.radians(max_lat))
+    south = math.floor((pizzeria_lats.min() - margin_lat) / cell_height) * cell_height
+    west = math.floor((pizzeria_lons.min() - margin_lon) / cell_width) * cell_width
+    rows = math.ceil((pizzeria_lats.max() + margin_lat - south) / cell_height)
+    cols = math.ceil((pizzeria_lons.max() + margin_lon - west) / cell_width)
+
+    cells = get_covered_cells(
+        pizzeria_lats, pizzeria_lons, south, west, rows, cols, cell_height, cell_width, margin_km,
+    )
+    thresholds = np.array([max_distance for max_distance, _ in DELIVERY_TIERS])
+    nearest = np.empty(len(cells), dtype=np.uint16)
+    tiers = np.empty(len(cells), dtype=np.uint8)
+
+    for start in range(0, len(cells), chunk_size):
+        lats = south + (cells[start:start + chunk_size] // cols + 0.5) * cell_height
+        lons = west + (cells[start:start + chunk_size] % cols + 0.5) * cell_width
+        radius = vectorized_haversine_km(
+            lats - cell_height / 2, lons - cell_width / 2,
+            lats + cell_height / 2, lons + cell_width / 2,
+        ) / 2
+        candidates = np.nonzero(
+            (pizzeria_lats >= lats[0] - 2 * margin_lat) & (pizzeria_lats <= lats[-1] + 2 * margin_lat)
+        )[0]
+        distances = vectorized_haversine_km(
+            lats[:, None], lons[:, None],
+            pizzeria_lats[None, candidates], pizzeria_lons[None, candidates],
+        )
+        order = np.argsort(distances, axis=1)[:, :2]
+        best = np.take_along_axis(distances, order[:, :1], axis=1)[:, 0]
+        if len(candidates) > 1:
+            second = np.take_along_axis(distances, order[:, 1:2], axis=1)[:, 0]
+        else:
+            second = np.full_like(best, np.inf)
+        tier = np.searchsorted(thresholds, best, side='right')
+
+        ambiguous = second - best <= 2 * radius + GEODESIC_TOLERANCE * second
+        slack = radius + GEODESIC_TOLERANCE * best
+        ambiguous |= (np.abs(best[:, None] - thresholds[None, :]) <= slack[:, None]).any(axis=1)
+        nearest[start:start + chunk_size] = np.where(ambiguous, BOUNDARY, candidates[order[:, 0]])
+        tiers[start:start + chunk_size] = tier
+
+    return DeliveryZones(
+        precision=precision,
+        south=south,
+        west=west,
+        rows=rows,
+        cols=cols,
+        pizzerias=[
+            {'id': pizzeria['id'], 'Alias': pizzeria.get('Alias'), 'Address': pizzeria.get('Address')}
+            for pizzeria in pizzerias
+        ],
+        fingerprint=get_pizzerias_fingerprint(pizzerias),
+        cells=array('q', cells.astype(np.int64).tobytes()),
+        nearest=array('H', nearest.tobytes()),
+        tiers=array('B', tiers.tobytes()),
+    )
+
+
+def pack_array(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(zlib.compress(values.tobytes())).decode()
+
+
+def unpack_array(typecode, packed):
+    values = array(typecode, zlib.decompress(base64.b64decode(packed)))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class DeliveryZones:
+    def __init__(self, precision, south, west, rows, cols, pizzerias, fingerprint, cells, nearest, tiers):
+        self.precision = precision
+        self.south = south
+        self.west = west
+        self.rows = rows
+        self.cols = cols
+        self.pizzerias = pizzerias
+        self.fingerprint = fingerprint
+        self.cells = cells
+        self.nearest = nearest
+        self.tiers = tiers
+        self.cell_height, self.cell_width = get_cell_size(precision)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, encoding='utf-8') as file:
+            stored = json.load(file)
+        nearest = unpack_array('H', stored['nearest'])
+        return cls(
+            precision=stored['precision'],
+            south=stored['south'],
+            west=stored['west'],
+            rows=stored['rows'],
+            cols=stored['cols'],
+            pizzerias=stored['pizzerias'],
+            fingerprint=stored['fingerprint'],
+            cells=unpack_array('q', stored['cells']) if 'cells' in stored else array('q', range(len(nearest))),
+            nearest=nearest,
+            tiers=unpack_array('B', stored['tiers']),
+        )
+
+    def save(self, file_path):
+        stored = {
+            'precision': self.precision,
+            'south': self.south,
+            'west': self.west,
+            'rows': self.rows,
+            'cols': self.cols,
+            'pizzerias': self.pizzerias,
+            'fingerprint': self.fingerprint,
+            'cells': pack_array(self.cells),
+            'nearest': pack_array(self.nearest),
+            'tiers': pack_array(self.tiers),
+        }
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(stored, file, ensure_ascii=False)
+
+    def lookup(self, lat, lon):
+        row = math.floor((lat - self.south) / self.cell_height)
+        col = math.floor((lon - self.west) / self.cell_width)
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return None
+        cell = row * self.cols + col
+        index = bisect.bisect_left(self.cells, cell)
+        if index == len(self.cells) or self.cells[index] != cell:
+            return None
+        nearest = self.nearest[index]
+        if nearest == BOUNDARY:
+            return None
+        return self.pizzerias[nearest]['id'], self.tiers[index]
+
+    def iter_cells(self):
+        for cell, nearest, tier in zip(self.cells, self.nearest, self.tiers):
+            row, col = divmod(cell, self.cols)
+            yield self.south + (row + 0.5) * self.cell_height, self.west + (col + 0.5) * self.cell_width, nearest, tier
+
+    def get_cell_area(self, lat):
+        return self.cell_height * KM_PER_DEGREE * self.cell_width * KM_PER_DEGREE * math.cos(math.radians(lat))
+
+
+class DeliveryZoneLocator:
+    def __init__(self, locator, zones=None):
+        self.locator = locator
+        self.zones = zones
+        self._stale_fingerprint = None
+
+    def locate(self, location):
+        self.locator.ensure_loaded()
+        zones = self.zones
+        fingerprint = self.locator.fingerprint
+        if zones and zones.fingerprint != fingerprint:
+            if self._stale_fingerprint != fingerprint:
+                self._stale_fingerprint = fingerprint
+                logger.warning('Сетка зон доставки не совпадает с текущим списком пиццерий, пересчитайте её')
+            zones = None
+        if zones:
+            found = zones.lookup(*map(float, location))
+            if found:
+                pizzeria = self.locator.get_pizzeria(found[0])
+                if pizzeria:
+                    return pizzeria, found[1]
+        nearest_place = self.locator.find_nearest(location)
+        return nearest_place, get_delivery_tier(nearest_place['distance'])
+
+
+def load_zones(file_path):
+    try:
+        zones = DeliveryZones.load(file_path)
+    except FileNotFoundError:
+        logger.warning('Файл зон доставки %s не найден, расстояния будут считаться точно', file_path)
+        return None
+    logger.info('Загружено зон доставки: %s', len(zones.cells))
+    return zones
+
+
+def get_tier_name(tier):
+    if tier == PICKUP_ONLY:
+        return 'только самовывоз'
+    return f'до {DELIVERY_TIERS[tier][0]} км, {DELIVERY_TIERS[tier][1]} руб.'
+
+
+def print_coverage_report(zones, csv_path=None):
+    tier_areas = [0.0] * (PICKUP_ONLY + 1)
+    pizzeria_areas = [[0.0] * (PICKUP_ONLY + 1) for _ in zones.pizzerias]
+    boundary_area = 0.0
+    writer = None
+    csv_file = open(csv_path, 'w', encoding='utf-8', newline='') if csv_path else None
+    if csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['geohash', 'lat', 'lon', 'pizzeria', 'tier', 'delivery_cost'])
+
+    for lat, lon, nearest, tier in zones.iter_cells():
+        area = zones.get_cell_area(lat)
+        if nearest == BOUNDARY:
+            boundary_area += area
+        else:
+            tier_areas[tier] += area
+            pizzeria_areas[nearest][tier] += area
+        if writer:
+            writer.writerow([
+                encode_geohash(lat, lon, zones.precision),
+                f'{lat:.6f}',
+                f'{lon:.6f}',
+                '' if nearest == BOUNDARY else zones.pizzerias[nearest]['Alias'],
+                'boundary' if nearest == BOUNDARY else tier,
+                '' if nearest == BOUNDARY else get_delivery_cost(tier),
+            ])
+    if csv_file:
+        csv_file.close()
+
+    total_area = sum(tier_areas) + boundary_area
+    print(f'Ячеек: {len(zones.cells)}(geohash точности {zones.precision}), площадь {total_area:.0f} км²')
+    for tier, area in enumerate(tier_areas):
+        print(f'{get_tier_name(tier)}: {area:.1f} км² ({area / total_area:.1%})')
+    print(f'На границах зон(точный расчёт): {boundary_area:.1f} км² ({boundary_area / total_area:.1%})')
+    print()
+    for pizzeria, areas in sorted(zip(zones.pizzerias, pizzeria_areas), key=lambda item: -sum(item[1][:PICKUP_ONLY])):
+        delivery = ', '.join(f'{area:.1f}' for area in areas[:PICKUP_ONLY])
+        print(f'{pizzeria["Alias"]}: доставка {delivery} км² по зонам')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Сетка зон доставки: ближайшая пиццерия и стоимость доставки')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='рассчитать сетку по пиццериям из moltin')
+    build_parser.add_argument('--output', default='delivery_zones.json', help='файл сетки')
+    build_parser.add_argument('--precision', type=int, default=7, help='точность geohash ячеек(7 - около 150 м)')
+    report_parser = subparsers.add_parser('report', help='отчёт о покрытии зон доставки')
+    report_parser.add_argument('zones', nargs='?', default='delivery_zones.json', help='файл сетки')
+    report_parser.add_argument('--csv', help='выгрузить ячейки в CSV')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        print_coverage_report(DeliveryZones.load(args.zones), args.csv)
+        return
+
+    env = Env()
+    env.read_env()
+    moltin_base_url = env('MOLTIN_BASE_URL')
+    token_provider = MoltinTokenProvider(moltin_base_url, env('MOLTIN_CLIENT_ID'), env('MOLTIN_CLIENT_SECRET'))
+    pizzerias = MoltinClient(moltin_base_url, token_provider).get_pizzerias()
+    zones = build_zone_grid(pizzerias, precision=args.precision)
+    zones.save(args.output)
+    token_provider.stop()
+    print_coverage_report(zones)
+
+
+if __name__ == '__main__':
+    main()
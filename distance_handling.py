@@ -1,24 +1,264 @@
-from textwrap import dedent
+import hashlib
+import heapq
+import logging
+import math
+import re
+import threading
+from concurrent.futures import Future
+from functools import partial
+
 import requests
 
+from metrics import timed
+from resilience import call_with_retries, CircuitBreaker, http_error
+
+logger = logging.getLogger(__name__)
+
+GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
+GEOCODER_TIMEOUT = (3.05, 5)
+GEOCODER_BREAKER = CircuitBreaker('geocoder')
+EARTH_RADIUS_KM = 6371.0088
+GEODESIC_TOLERANCE = 0.01
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'гор': 'город',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'пл': 'площадь',
+    'наб': 'набережная',
+    'ш': 'шоссе',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'кв': 'квартира',
+}
+
+
+@timed('geocoder')
+def geocode(apikey, address, url=GEOCODER_URL, timeout=GEOCODER_TIMEOUT, breaker=GEOCODER_BREAKER,
+            attempts=2, deadline=6):
+    def request():
+        response = requests.get(url, params={
+            "geocode": address,
+            "apikey": apikey,
+            "format": "json",
+        }, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    return parse_geocoder_response(call_with_retries(request, attempts, breaker, deadline=deadline))
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
+
+async def geocode_async(session, apikey, address, url=GEOCODER_URL):
+    params = {
         "geocode": address,
         "apikey": apikey,
         "format": "json",
-    })
-    response.raise_for_status()
-    found_places = response.json()["response"]["GeoObjectCollection"]["featureMember"]
+    }
+    async with session.get(url, params=params) as response:
+        if response.status >= 400:
+            raise http_error(response.status, 'geocoder error')
+        return parse_geocoder_response(await response.json())
+
+
+def parse_geocoder_response(payload):
+    found_places = payload["response"]["GeoObjectCollection"]["featureMember"]
 
     if not found_places:
-        raise requests.exceptions.RequestException
+        return None
 
     most_relevant = found_places[0]
     lon, lat = most_relevant["GeoObject"]["Point"]["pos"].split(" ")
     return lat, lon
 
 
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[^\w\s-]', ' ', address)
+    words = []
+    for word in address.split():
+        word = word.strip('-')
+        if word:
+            words.append(ADDRESS_ABBREVIATIONS.get(word, word))
+    return ' '.join(words)
+
+
+class GeocodeCache:
+    def __init__(self, redis_db, apikey, ttl=30 * 24 * 3600, negative_ttl=600, prefix='geocode:', lookup=None):
+        self.redis_db = redis_db
+        self.apikey = apikey
+        self.lookup = lookup or partial(geocode, apikey)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def fetch_coordinates(self, address):
+        key = self.prefix + normalize_address(address)
+        cached = self.redis_db.get(key)
+        if cached is not None:
+            return tuple(cached.split(',')) if cached else None
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+        if not is_leader:
+            return future.result()
+
+        try:
+            coordinates = self.lookup(address)
+            if coordinates:
+                self.redis_db.set(key, ','.join(coordinates), ex=self.ttl)
+            else:
+                self.redis_db.set(key, '', ex=self.negative_ttl)
+            future.set_result(coordinates)
+            return coordinates
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+def get_pizzerias_fingerprint(pizzerias):
+    points = sorted(f"{pizzeria['id']}:{pizzeria['Latitude']}:{pizzeria['Longitude']}" for pizzeria in pizzerias)
+    return hashlib.sha1('|'.join(points).encode()).hexdigest()
+
+
 def get_distance(pizzeria):
     return pizzeria['distance']
+
+
+def to_unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    cos_lat = math.cos(lat)
+    return cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat)
+
+
+def chord_to_km(squared_chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(squared_chord) / 2))
+
+
+class KDTree:
+    def __init__(self, points):
+        self.root = self._build(list(points), 0)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        return (
+            points[median],
+            axis,
+            self._build(points[:median], depth + 1),
+            self._build(points[median + 1:], depth + 1),
+        )
+
+    def nearest(self, target, k=1):
+        heap = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            (vector, item), axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(vector, target))
+            entry = (-squared, id(item), item)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif squared < -heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+            delta = target[axis] - vector[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            if len(heap) < k or delta ** 2 < -heap[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return [(-squared, item) for squared, _, item in sorted(heap, reverse=True)]
+
+
+class PizzeriaLocator:
+    def __init__(self, fetch_pizzerias, refresh_interval=300, retry_interval=30):
+        self.fetch_pizzerias = fetch_pizzerias
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.fingerprint = None
+        self.pizzerias = []
+        self.refreshed = threading.Event()
+        self._tree = None
+        self._by_id = {}
+        self._stop = threading.Event()
+
+    def refresh(self):
+        self.update(list(self.fetch_pizzerias()))
+        self.refreshed.set()
+
+    def update(self, pizzerias):
+        points = []
+        for pizzeria in pizzerias:
+            lat, lon = float(pizzeria['Latitude']), float(pizzeria['Longitude'])
+            points.append((to_unit_vector(lat, lon), pizzeria))
+        self._tree = KDTree(points)
+        self._by_id = {pizzeria['id']: pizzeria for pizzeria in pizzerias}
+        self.pizzerias = pizzerias
+        self.fingerprint = get_pizzerias_fingerprint(pizzerias)
+        logger.info('Загружено пиццерий: %s', len(points))
+
+    def get_pizzeria(self, pizzeria_id):
+        return self._by_id.get(pizzeria_id)
+
+    def start(self):
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while True:
+            delay = self.refresh_interval
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Не удалось обновить список пиццерий')
+                delay = self.retry_interval
+            if self._stop.wait(delay):
+                return
+
+    def ensure_loaded(self):
+        if self._tree is None:
+            self.refresh()
+
+    def nearest(self, location, k=1):
+        self.ensure_loaded()
+        lat, lon = map(float, location)
+        return [
+            (pizzeria, chord_to_km(squared))
+            for squared, pizzeria in self._tree.nearest(to_unit_vector(lat, lon), k)
+        ]
+
+    def find_nearest(self, location, k=3):
+        from geopy import distance
+
+        candidates = self.nearest(location, k)
+        if not candidates:
+            return None
+        best_haversine = candidates[0][1]
+        nearest_place = None
+        for pizzeria, haversine in candidates:
+            if haversine > best_haversine * (1 + GEODESIC_TOLERANCE):
+                break
+            geodesic = distance.distance((pizzeria['Latitude'], pizzeria['Longitude']), location).km
+            if nearest_place is None or geodesic < nearest_place['distance']:
+                nearest_place = {**pizzeria, 'distance': geodesic}
+        return nearest_place
@@ -0,0 +1,85 @@
+import json
+
+CHUNK_SIZE = 64 * 1024
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+
+def iter_records(file_path, input_format='auto', chunk_size=CHUNK_SIZE):
+    with open(file_path, encoding='utf-8') as file:
+        if input_format == 'auto':
+            input_format = detect_format(file)
+        if input_format == 'ndjson':
+            yield from iter_ndjson(file)
+        else:
+            yield from iter_json_array(file, chunk_size)
+
+
+def detect_format(file):
+    position = file.tell()
+    while True:
+        char = file.read(1)
+        if not char or not char.isspace():
+            break
+    file.seek(position)
+    return 'json' if char == '[' else 'ndjson'
+
+
+def iter_ndjson(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json_array(file, chunk_size=CHUNK_SIZE, max_record_size=MAX_RECORD_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    read_size = chunk_size
+    eof = False
+    expected = 'array'
+
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == 'array':
+                if char != '[':
+                    raise ValueError('Ожидался JSON-массив')
+                expected = 'first_record'
+                position += 1
+                continue
+            if char == ']' and expected in ('first_record', 'separator'):
+                return
+            if expected == 'separator':
+                if char != ',':
+                    raise ValueError(f'Ожидалась запятая между элементами JSON-массива, найдено {char!r}')
+                expected = 'record'
+                position += 1
+                continue
+            if char in ',]':
+                raise ValueError(f'Ожидался элемент JSON-массива, найдено {char!r}')
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                if len(buffer) - position > max_record_size:
+                    raise ValueError(f'Элемент JSON-массива не уложился в {max_record_size} символов')
+                read_size = max(chunk_size, len(buffer) - position)
+            else:
+                if end < len(buffer) or eof:
+                    yield record
+                    position = end
+                    read_size = chunk_size
+                    expected = 'separator'
+                    continue
+        elif eof:
+            raise ValueError('Неожиданный конец JSON-массива')
+
+        chunk = file.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
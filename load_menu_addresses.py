@@ -1,40 +1,252 @@
 import argparse
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
 import requests
 from environs import Env
 
-from moltin_tools import (
-    load_menu_moltin,
-    load_addresses_moltin,
-    get_api_key,
-    create_flow,
-    create_flow_field
-)
+from catalog_cache import publish_invalidation
+from json_stream import iter_records
+from moltin_sync import get_source_id, plan_addresses_sync, plan_menu_sync, SyncCheckpoint
+from moltin_tools import MoltinClient, MoltinTokenProvider
+from rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class LoadStats:
+    def __init__(self, name, report_every=50):
+        self.name = name
+        self.report_every = report_every
+        self.done = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def success(self):
+        with self._lock:
+            self.done += 1
+            if self.done % self.report_every == 0:
+                print(f'{self.name}: загружено {self.done}, ошибок {self.failed}')
+
+    def failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def report(self):
+        elapsed = time.monotonic() - self.started_at
+        throughput = self.done / elapsed if elapsed else 0
+        print(
+            f'{self.name}: загружено {self.done}, ошибок {self.failed} '
+            f'за {elapsed:.1f} с ({throughput:.1f} в секунду)'
+        )
+
+
+class InFlightLimiter:
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def submit(self, function, *args):
+        self._slots.acquire()
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def join(self):
+        for _ in range(self.limit):
+            self._slots.acquire()
+        for _ in range(self.limit):
+            self._slots.release()
+
+
+class BulkLoader:
+    def __init__(self, moltin, concurrency=8, queue_size=None):
+        self.moltin = moltin
+        queue_size = queue_size or concurrency * 4
+        self.records = InFlightLimiter(
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='loader'),
+            queue_size,
+        )
+        self.images = InFlightLimiter(
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='images'),
+            queue_size,
+        )
+
+    def load_menu(self, menu):
+        products = LoadStats('Продукты')
+        images = LoadStats('Картинки')
+        for pizza in menu:
+            self.records.submit(self._create_product, pizza, products, images)
+        self.records.join()
+        self.images.join()
+        products.report()
+        images.report()
+
+    def load_addresses(self, addresses):
+        stats = LoadStats('Пиццерии')
+        for address in addresses:
+            self.records.submit(self._create_pizzeria, address, stats)
+        self.records.join()
+        stats.report()
+
+    def run_sync(self, checkpoint):
+        stats = LoadStats('Изменения')
+        images = LoadStats('Картинки')
+        for operation in checkpoint.iter_operations():
+            if not checkpoint.is_done(operation['key']):
+                self.records.submit(self._apply_operation, operation, checkpoint, stats, images)
+            elif operation['action'] == 'create_product':
+                self._submit_sync_image(operation, checkpoint.done[operation['key']], checkpoint, images)
+        self.records.join()
+        self.images.join()
+        stats.report()
+        images.report()
+        return not stats.failed and not images.failed
+
+    def _apply_operation(self, operation, checkpoint, stats, images):
+        action = operation['action']
+        try:
+            if action == 'create_product':
+                record_id = self.moltin.create_product(operation['record'])
+            elif action == 'create_pizzeria':
+                record_id = self.moltin.create_pizzeria(operation['record'])['id']
+            elif action in ('update_product', 'update_pizzeria'):
+                record_id = operation['id']
+                getattr(self.moltin, action)(record_id, operation['record'])
+            else:
+                record_id = operation['id']
+                getattr(self.moltin, action)(record_id)
+        except requests.exceptions.RequestException:
+            logger.exception('Ошибка при выполнении %s', operation['key'])
+            stats.failure()
+            return
+        checkpoint.mark_done(operation['key'], record_id)
+        stats.success()
+        if action == 'create_product':
+            self._submit_sync_image(operation, record_id, checkpoint, images)
+
+    def _submit_sync_image(self, operation, product_id, checkpoint, images):
+        image_key = operation['key'].replace(':create:', ':image:', 1)
+        if not checkpoint.is_done(image_key):
+            self.images.submit(self._set_product_image, operation['record'], product_id, images, checkpoint, image_key)
+
+    def _create_product(self, pizza, products, images):
+        try:
+            product_id = self.moltin.create_product(pizza)
+        except requests.exceptions.RequestException:
+            logger.exception('Ошибка при загрузке продукта %s', pizza['id'])
+            products.failure()
+            return
+        products.success()
+        self.images.submit(self._set_product_image, pizza, product_id, images)
+
+    def _set_product_image(self, pizza, product_id, images, checkpoint=None, image_key=None):
+        try:
+            self.moltin.set_product_image(pizza['product_image']['url'], product_id)
+        except requests.exceptions.RequestException:
+            logger.exception('Ошибка при загрузке картинки продукта %s', pizza['id'])
+            images.failure()
+            return
+        if checkpoint:
+            checkpoint.mark_done(image_key)
+        images.success()
+
+    def _create_pizzeria(self, address, stats):
+        try:
+            self.moltin.create_pizzeria(address)
+        except requests.exceptions.RequestException:
+            logger.exception('Ошибка при загрузке адреса %s', address['alias'])
+            stats.failure()
+            return
+        stats.success()
+
+
+def sync_file(loader, kind, file_path, plan, args):
+    source_id = get_source_id(kind, file_path)
+    checkpoint = SyncCheckpoint(f'{args.checkpoint}.{kind}')
+    if checkpoint.resume(source_id):
+        print(f'Продолжаю прерванную синхронизацию {file_path}')
+    else:
+        operations = plan(loader.moltin, iter_records(file_path, args.format))
+        checkpoint.start(source_id, operations)
+    print(f'{file_path}: изменений {checkpoint.planned}')
+    if loader.run_sync(checkpoint):
+        checkpoint.finish()
+    else:
+        print('Синхронизация завершена с ошибками, повторный запуск продолжит её')
+
+
+def notify_catalog_changed(env):
+    redis_host = env('REDIS_HOST', None)
+    if not redis_host:
+        return
+    redis_db = redis.Redis(
+        host=redis_host,
+        port=env('REDIS_PORT'),
+        db=env('REDIS_DB', 0),
+        username=env('REDIS_USERNAME'),
+        password=env('REDIS_PASSWORD'),
+        decode_responses=True
+    )
+    publish_invalidation(redis_db)
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     env = Env()
     env.read_env()
     moltin_client_id = env('MOLTIN_CLIENT_ID')
     moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
     moltin_base_url = env('MOLTIN_BASE_URL')
-    api_key = get_api_key(moltin_base_url, moltin_client_id, moltin_client_secret)
     parser = argparse.ArgumentParser()
     parser.add_argument("--load_menu", help="загрузить меню(укажите адрес файла)")
     parser.add_argument("--load_addresses", help="загрузить адреса пиццерий(укажите адрес файла)")
     parser.add_argument("--create_pizzeria_flow", help="создать flow для пиццерии", action='store_true')
+    parser.add_argument("--concurrency", help="число параллельных запросов", type=int, default=8)
+    parser.add_argument("--rps", help="ограничение запросов в секунду(0 - без ограничения)", type=float, default=10)
+    parser.add_argument(
+        "--format",
+        help="формат входных файлов: json(массив), ndjson или auto",
+        choices=['auto', 'json', 'ndjson'],
+        default='auto',
+    )
+    parser.add_argument(
+        "--sync",
+        help="загрузить только отличия от данных в moltin(создать, обновить и удалить записи)",
+        action='store_true',
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="префикс файла контрольной точки для --sync",
+        default='.sync_checkpoint',
+    )
     args = parser.parse_args()
     menu_path = args.load_menu
     addresses_path = args.load_addresses
 
+    token_provider = MoltinTokenProvider(moltin_base_url, moltin_client_id, moltin_client_secret)
+    moltin = MoltinClient(
+        moltin_base_url,
+        token_provider,
+        pool_size=args.concurrency * 2,
+        rate_limiter=RateLimiter(args.rps, burst=args.concurrency),
+    )
+    loader = BulkLoader(moltin, concurrency=args.concurrency)
+
     if menu_path:
-        try:
-            load_menu_moltin(api_key, moltin_base_url, menu_path)
-        except requests.exceptions.HTTPError:
-            logging.exception('Ошибка при загрузке продукта')
+        if args.sync:
+            sync_file(loader, 'menu', menu_path, plan_menu_sync, args)
+        else:
+            loader.load_menu(iter_records(menu_path, args.format))
+        notify_catalog_changed(env)
 
     if args.create_pizzeria_flow:
-        flow_id = create_flow(api_key, moltin_base_url)
+        flow_id = moltin.create_flow()
         flow_fields = [
             'Address',
             'Alias',
@@ -42,14 +254,16 @@ def main():
             'Latitude',
         ]
         for field in flow_fields:
-            create_flow_field(api_key, moltin_base_url, field, flow_id)
+            moltin.create_flow_field(field, flow_id)
 
     if addresses_path:
-        try:
-            load_addresses_moltin(api_key, moltin_base_url, addresses_path)
-        except requests.exceptions.HTTPError:
-            logging.exception('Ошибка при загрузке адреса')
-            
+        if args.sync:
+            sync_file(loader, 'addresses', addresses_path, plan_addresses_sync, args)
+        else:
+            loader.load_addresses(iter_records(addresses_path, args.format))
+
+    token_provider.stop()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,120 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HANDLER_DURATION = Histogram(
+    'bot_handler_duration_seconds',
+    'Время обработки обновления',
+    ['state', 'handler'],
+    buckets=BUCKETS,
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total',
+    'Ошибки при обработке обновления',
+    ['state', 'handler'],
+)
+HANDLER_QUEUE_DEPTH = Gauge(
+    'bot_handler_queue_depth',
+    'Обновления, ожидающие обработки',
+)
+HANDLER_ACTIVE_CHATS = Gauge(
+    'bot_handler_active_chats',
+    'Чаты с необработанными обновлениями',
+)
+HANDLER_QUEUE_WAIT = Histogram(
+    'bot_handler_queue_wait_seconds',
+    'Время ожидания обновления в очереди',
+    buckets=BUCKETS,
+)
+BOT_READY = Gauge(
+    'bot_ready',
+    'Каталог и пиццерии загружены из moltin после запуска',
+)
+UPSTREAM_DURATION = Histogram(
+    'upstream_request_duration_seconds',
+    'Время запроса к внешнему сервису',
+    ['service', 'operation'],
+    buckets=BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    'upstream_request_errors_total',
+    'Ошибки запросов к внешнему сервису',
+    ['service', 'operation'],
+)
+TELEGRAM_OUTBOX_DEPTH = Gauge(
+    'telegram_outbox_depth',
+    'Сообщения, ожидающие отправки в Telegram',
+    ['priority'],
+)
+TELEGRAM_OUTBOX_LATENCY = Histogram(
+    'telegram_outbox_latency_seconds',
+    'Время от постановки сообщения в очередь до его отправки',
+    ['priority'],
+    buckets=BUCKETS,
+)
+TELEGRAM_FLOOD_WAITS = Counter(
+    'telegram_flood_waits_total',
+    'Ответы Telegram с просьбой подождать(retry_after)',
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    'upstream_circuit_open',
+    'Запросы к внешнему сервису временно отклоняются',
+    ['service'],
+)
+
+
+@contextmanager
+def observe(histogram, errors, **labels):
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.labels(**labels).inc()
+        raise
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started_at)
+
+
+def observe_upstream(service, operation):
+    return observe(UPSTREAM_DURATION, UPSTREAM_ERRORS, service=service, operation=operation)
+
+
+def timed(service):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with observe_upstream(service, function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_callback_name(callback):
+    callback = getattr(callback, 'func', callback)
+    return getattr(callback, '__name__', repr(callback))
+
+
+def instrument_callback(callback, state):
+    labels = {'state': state, 'handler': get_callback_name(callback)}
+
+    @wraps(callback)
+    def wrapper(update, context):
+        with observe(HANDLER_DURATION, HANDLER_ERRORS, **labels):
+            return callback(update, context)
+    return wrapper
+
+
+def instrument_conversation(conversation_handler):
+    groups = [('entry', conversation_handler.entry_points), ('fallback', conversation_handler.fallbacks)]
+    groups += [(getattr(state, 'name', str(state)), handlers) for state, handlers in conversation_handler.states.items()]
+    for state, handlers in groups:
+        for handler in handlers:
+            handler.callback = instrument_callback(handler.callback, state)
+
+
+def start_metrics_server(port, address='127.0.0.1'):
+    start_http_server(port, addr=address)
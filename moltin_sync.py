@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+
+
+def get_source_id(kind, file_path):
+    stat = os.stat(file_path)
+    return f'{kind}:{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def plan_menu_sync(moltin, menu):
+    remote = {}
+    for product in moltin.iter_products():
+        sku = product.get('sku')
+        if sku in remote:
+            yield {'key': f'product:delete:{product["id"]}', 'action': 'delete_product', 'id': product['id']}
+        else:
+            remote[sku] = product
+
+    for pizza in menu:
+        sku = str(pizza['id'])
+        product = remote.pop(sku, None)
+        if product is None:
+            yield {'key': f'product:create:{sku}', 'action': 'create_product', 'record': pizza}
+        elif is_product_changed(product, pizza):
+            yield {
+                'key': f'product:update:{sku}',
+                'action': 'update_product',
+                'id': product['id'],
+                'record': pizza,
+            }
+
+    for product in remote.values():
+        yield {'key': f'product:delete:{product["id"]}', 'action': 'delete_product', 'id': product['id']}
+
+
+def is_product_changed(product, pizza):
+    price = product.get('price') or [{}]
+    return (
+        product.get('name') != pizza['name']
+        or product.get('description') != pizza['description']
+        or price[0].get('amount') != pizza['price']
+    )
+
+
+def plan_addresses_sync(moltin, addresses):
+    remote = {}
+    for entry in moltin.iter_pizzerias():
+        alias = entry.get('Alias')
+        if alias in remote:
+            yield {'key': f'pizzeria:delete:{entry["id"]}', 'action': 'delete_pizzeria', 'id': entry['id']}
+        else:
+            remote[alias] = entry
+
+    for address in addresses:
+        fields = moltin.pizzeria_fields(address)
+        entry = remote.pop(fields['Alias'], None)
+        if entry is None:
+            yield {
+                'key': f'pizzeria:create:{fields["Alias"]}',
+                'action': 'create_pizzeria',
+                'record': address,
+            }
+        elif any(entry.get(name) != value for name, value in fields.items()):
+            yield {
+                'key': f'pizzeria:update:{fields["Alias"]}',
+                'action': 'update_pizzeria',
+                'id': entry['id'],
+                'record': address,
+            }
+
+    for entry in remote.values():
+        yield {'key': f'pizzeria:delete:{entry["id"]}', 'action': 'delete_pizzeria', 'id': entry['id']}
+
+
+class SyncCheckpoint:
+    def __init__(self, path):
+        self.path = path
+        self.planned = 0
+        self.done = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def resume(self, source_id):
+        if not os.path.exists(self.path):
+            return False
+        planned = None
+        done = {}
+        with open(self.path, encoding='utf-8') as file:
+            header = parse_entry(file.readline())
+            if not header or header.get('source') != source_id:
+                return False
+            line = '\n'
+            for line in file:
+                entry = parse_entry(line)
+                if entry is None:
+                    continue
+                if 'planned' in entry:
+                    planned = entry['planned']
+                elif 'key' in entry:
+                    done[entry['key']] = entry.get('id')
+            ends_with_newline = line.endswith('\n')
+        if planned is None:
+            return False
+        self.planned = planned
+        self.done = done
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if not ends_with_newline:
+            self._file.write('\n')
+        return True
+
+    def start(self, source_id, operations):
+        self.planned = 0
+        self.done = {}
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._file.write(dump_entry({'source': source_id}))
+        for operation in operations:
+            self._file.write(dump_entry({'operation': operation}))
+            self.planned += 1
+        self._write({'planned': self.planned})
+
+    def iter_operations(self):
+        with open(self.path, encoding='utf-8') as file:
+            file.readline()
+            for line in file:
+                entry = json.loads(line)
+                if 'planned' in entry:
+                    return
+                yield entry['operation']
+
+    def is_done(self, key):
+        return key in self.done
+
+    def mark_done(self, key, record_id=None):
+        with self._lock:
+            self.done[key] = record_id
+            self._write({'key': key, 'id': record_id})
+
+    def finish(self):
+        self._file.close()
+        os.remove(self.path)
+
+    def _write(self, entry):
+        self._file.write(dump_entry(entry))
+        self._file.flush()
+
+
+def dump_entry(entry):
+    return json.dumps(entry, ensure_ascii=False) + '\n'
+
+
+def parse_entry(line):
+    try:
+        return json.loads(line or 'null')
+    except json.JSONDecodeError:
+        return None
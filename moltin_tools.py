@@ -1,249 +1,344 @@
-import json
 import logging
-from datetime import datetime
-from urllib.parse import urljoin
+import threading
+import time
+from functools import partial
+from urllib.parse import urljoin, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
-_api_key = None
-_expires = None
+from metrics import timed
+from resilience import call_with_retries, CircuitBreaker
 
+logger = logging.getLogger(__name__)
 
-def get_api_key(base_url, client_id, client_secret):
-    global _api_key
-    global _expires
+DEFAULT_TIMEOUTS = {
+    ('GET', '/v2/products'): (3.05, 10),
+    ('GET', '/v2/files'): (3.05, 3),
+    ('GET', '/v2/carts'): (3.05, 3),
+    ('GET', '/v2/customers'): (3.05, 3),
+    ('GET', '/v2/flows'): (3.05, 10),
+    ('POST', '/v2/carts'): (3.05, 5),
+    ('DELETE', '/v2/carts'): (3.05, 5),
+    ('POST', '/v2/customers'): (3.05, 5),
+    ('PUT', '/v2/customers'): (3.05, 5),
+    ('POST', '/v2/files'): (3.05, 30),
+}
+
+
+def request_access_token(base_url, client_id, client_secret, session=requests):
     url = urljoin(base_url, '/oauth/access_token')
     payload = {
         'client_id': client_id,
         'client_secret': client_secret,
         'grant_type': 'client_credentials',
     }
-    current_time = datetime.now()
-    timestamp = int(datetime.timestamp(current_time))
-    if _expires:
-        if timestamp < _expires:
-            return _api_key
-
-    response = requests.post(url, data=payload)
+    response = session.post(url, data=payload, timeout=10)
     response.raise_for_status()
     token_params = response.json()
-    _api_key = token_params['access_token']
-    _expires = token_params['expires']
-    return _api_key
-
-
-def get_products(base_url, api_key):
-    url = urljoin(base_url, '/v2/products')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def add_product_to_cart(base_url, api_key, product_id, quantity, user_id):
-    url = urljoin(base_url, f'/v2/carts/{user_id}/items')
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'X-MOLTIN-CURRENCY': 'RUB',
-    }
-    payload = {
-        "data": {
-            "type": "cart_item",
-            "id": product_id,
-            "quantity": int(quantity),
-        }
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
-
-
-def get_cart(base_url, api_key, user_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/carts/{user_id}/items')
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-
-def get_product(base_url, api_key, product_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/products/{product_id}')
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def fetch_image(base_url, api_key, image_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/files/{image_id}')
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]["link"]["href"]
-
-
-def remove_item_from_cart(base_url, api_key, user_id, product_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/carts/{user_id}/items/{product_id}')
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
-
-
-def create_customer(base_url, api_key, user_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, '/v2/customers')
-    payload = {
-        "data": {
-            "type": "customer",
-            "name": user_id,
-            "email": f'{user_id}@plug.com',
+    return token_params['access_token'], token_params['expires']
+
+
+class StaticToken:
+    def __init__(self, api_key):
+        self.token = api_key
+
+    def refresh(self, stale_token=None):
+        return self.token
+
+
+class MoltinTokenProvider:
+    def __init__(self, base_url, client_id, client_secret, refresh_margin=300, retry_interval=30):
+        self.base_url = base_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._token = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def token(self):
+        if self._token is None or time.time() >= self._expires:
+            return self.refresh(stale_token=self._token)
+        return self._token
+
+    def start(self):
+        self.refresh()
+
+    def start_in_background(self):
+        self._schedule(0)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+
+    def refresh(self, stale_token=None):
+        with self._lock:
+            if self._token != stale_token and time.time() < self._expires:
+                return self._token
+            self._token, self._expires = request_access_token(
+                self.base_url,
+                self.client_id,
+                self.client_secret,
+            )
+            self._schedule(max(self._expires - time.time() - self.refresh_margin, 0))
+            return self._token
+
+    def _schedule(self, delay):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh(stale_token=self._token)
+        except Exception:
+            logger.exception('Не удалось обновить токен moltin')
+            self._schedule(self.retry_interval)
+
+
+class MoltinClient:
+    def __init__(self, base_url, token_provider, pool_size=10, timeout=(3.05, 10), currency='RUB',
+                 rate_limiter=None, timeouts=None, breaker=None, read_attempts=3, read_deadline=10):
+        if isinstance(token_provider, str):
+            token_provider = StaticToken(token_provider)
+        self.base_url = base_url
+        self.token_provider = token_provider
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker('moltin')
+        self.read_attempts = read_attempts
+        self.read_deadline = read_deadline
+        self.currency = currency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+    def close(self):
+        self.session.close()
+
+    def get_timeout(self, method, path):
+        path = urlsplit(path).path
+        for (timeout_method, prefix), timeout in self.timeouts.items():
+            if method == timeout_method and path.startswith(prefix):
+                return timeout
+        return self.timeout
+
+    def _request(self, method, path, headers=None, **kwargs):
+        kwargs.setdefault('timeout', self.get_timeout(method, path))
+        if method != 'GET':
+            return call_with_retries(partial(self._send, method, path, headers, kwargs), 1, self.breaker)
+        return call_with_retries(
+            partial(self._send, method, path, headers, kwargs),
+            self.read_attempts,
+            self.breaker,
+            deadline=self.read_deadline,
+        )
+
+    def _send(self, method, path, headers, kwargs):
+        url = urljoin(self.base_url, path)
+        token = self.token_provider.token
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+        response = self.session.request(method, url, headers=self._headers(token, headers), **kwargs)
+        if response.status_code == 401:
+            token = self.token_provider.refresh(stale_token=token)
+            response = self.session.request(method, url, headers=self._headers(token, headers), **kwargs)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _headers(token, headers=None):
+        return {'Authorization': f'Bearer {token}', **(headers or {})}
+
+    @timed('moltin')
+    def get_products(self):
+        return list(self.iter_products())
+
+    def iter_products(self, page_size=100):
+        return self.iter_pages('/v2/products', page_size)
+
+    def iter_pages(self, path, page_size=100):
+        params = {'page[limit]': page_size, 'page[offset]': 0}
+        while path:
+            payload = self._request('GET', path, params=params).json()
+            yield from payload['data']
+            links = payload.get('links') or {}
+            if not links.get('next') or links['next'] == links.get('current') or len(payload['data']) < page_size:
+                return
+            path, params = links['next'], None
+
+    @timed('moltin')
+    def get_product(self, product_id):
+        return self._request('GET', f'/v2/products/{product_id}').json()['data']
+
+    @timed('moltin')
+    def fetch_image(self, image_id):
+        return self._request('GET', f'/v2/files/{image_id}').json()['data']['link']['href']
+
+    @timed('moltin')
+    def add_product_to_cart(self, product_id, quantity, user_id):
+        payload = {
+            'data': {
+                'type': 'cart_item',
+                'id': product_id,
+                'quantity': int(quantity),
+            }
         }
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']['id']
-
-
-def get_customer(base_url, api_key, customer_id):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/customers/{customer_id}')
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-
-def update_customer(base_url, api_key, customer_id, email):
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = urljoin(base_url, f'/v2/customers/{customer_id}')
-    payload = {
-        "data": {
-            "type": "customer",
-            "email": email,
+        response = self._request(
+            'POST',
+            f'/v2/carts/{user_id}/items',
+            headers={'X-MOLTIN-CURRENCY': self.currency},
+            json=payload,
+        )
+        return response.json()
+
+    @timed('moltin')
+    def get_cart(self, user_id):
+        return self._request('GET', f'/v2/carts/{user_id}/items').json()
+
+    @timed('moltin')
+    def remove_item_from_cart(self, user_id, product_id):
+        return self._request('DELETE', f'/v2/carts/{user_id}/items/{product_id}').json()
+
+    @timed('moltin')
+    def create_customer(self, user_id):
+        payload = {
+            'data': {
+                'type': 'customer',
+                'name': user_id,
+                'email': f'{user_id}@plug.com',
+            }
         }
-    }
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
+        return self._request('POST', '/v2/customers', json=payload).json()['data']['id']
 
+    @timed('moltin')
+    def get_customer(self, customer_id):
+        return self._request('GET', f'/v2/customers/{customer_id}').json()
 
-def load_menu_moltin(api_key, base_url, file_path):
-    url = urljoin(base_url, '/v2/products')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    with open(file_path, 'rb') as file:
-        menu = json.load(file)
-    for pizza in menu:
+    @timed('moltin')
+    def update_customer(self, customer_id, email):
         payload = {
-            "data": {
-                "type": "product",
-                "name": pizza['name'],
-                "slug": f"pizza-{pizza['id']}",
-                "sku": str(pizza['id']),
-                "description": pizza['description'],
-                "manage_stock": False,
-                "price": [
-                    {
-                        "amount": pizza['price'],
-                        "currency": "RUB",
-                        "includes_tax": True
-                    }
-                ],
-                "status": "live",
-                "commodity_type": "physical"
+            'data': {
+                'type': 'customer',
+                'email': email,
             }
         }
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        set_product_image(api_key, base_url, pizza['product_image']['url'], response.json()['data']['id'])
+        return self._request('PUT', f'/v2/customers/{customer_id}', json=payload).json()
+
+    def product_fields(self, pizza):
+        return {
+            'name': pizza['name'],
+            'slug': f"pizza-{pizza['id']}",
+            'sku': str(pizza['id']),
+            'description': pizza['description'],
+            'manage_stock': False,
+            'price': [
+                {
+                    'amount': pizza['price'],
+                    'currency': self.currency,
+                    'includes_tax': True
+                }
+            ],
+            'status': 'live',
+            'commodity_type': 'physical'
+        }
 
+    @timed('moltin')
+    def create_product(self, pizza):
+        payload = {'data': {'type': 'product', **self.product_fields(pizza)}}
+        return self._request('POST', '/v2/products', json=payload).json()['data']['id']
 
-def load_addresses_moltin(api_key, base_url, file_path):
+    @timed('moltin')
+    def update_product(self, product_id, pizza):
+        payload = {'data': {'type': 'product', 'id': product_id, **self.product_fields(pizza)}}
+        return self._request('PUT', f'/v2/products/{product_id}', json=payload).json()['data']
 
-    with open(file_path, 'rb') as file:
-        addresses = json.load(file)
+    @timed('moltin')
+    def delete_product(self, product_id):
+        self._request('DELETE', f'/v2/products/{product_id}')
 
-    url = urljoin(base_url, f'v2/flows/pizzeria/entries')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    for address in addresses:
+    @timed('moltin')
+    def set_product_image(self, image_url, product_id):
+        files = {
+            'file_location': (None, image_url),
+        }
+        image_id = self._request('POST', '/v2/files', files=files).json()['data']['id']
         payload = {
             'data': {
-                'type': 'entry',
-                'Address': address['address']['full'],
-                'Alias': address['alias'],
-                'Longitude': str(address['coordinates']['lon']),
-                'Latitude': str(address['coordinates']['lat']),
+                'type': 'main_image',
+                'id': image_id,
             },
         }
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        self._request('POST', f'/v2/products/{product_id}/relationships/main-image', json=payload)
+
+    @staticmethod
+    def pizzeria_fields(address):
+        return {
+            'Address': address['address']['full'],
+            'Alias': address['alias'],
+            'Longitude': str(address['coordinates']['lon']),
+            'Latitude': str(address['coordinates']['lat']),
+        }
 
+    @timed('moltin')
+    def create_pizzeria(self, address):
+        payload = {'data': {'type': 'entry', **self.pizzeria_fields(address)}}
+        return self._request('POST', '/v2/flows/pizzeria/entries', json=payload).json()['data']
 
+    @timed('moltin')
+    def update_pizzeria(self, entry_id, address):
+        payload = {'data': {'type': 'entry', 'id': entry_id, **self.pizzeria_fields(address)}}
+        return self._request('PUT', f'/v2/flows/pizzeria/entries/{entry_id}', json=payload).json()['data']
 
-def set_product_image(api_key, base_url, image_url, product_id):
-    url = urljoin(base_url, '/v2/files')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    files = {
-        'file_location': (None, image_url),
-    }
-    response = requests.post(url, headers=headers, files=files)
-    response.raise_for_status()
-    image_id = response.json()['data']['id']
-    url = urljoin(base_url, f'/v2/products/{product_id}/relationships/main-image')
-    payload = {
-        'data': {
-            'type': 'main_image',
-            'id': image_id,
-        },
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    @timed('moltin')
+    def delete_pizzeria(self, entry_id):
+        self._request('DELETE', f'/v2/flows/pizzeria/entries/{entry_id}')
 
+    def iter_pizzerias(self, page_size=100):
+        return self.iter_pages('/v2/flows/pizzeria/entries', page_size)
 
-def create_flow(api_key, base_url):
-    url = urljoin(base_url, '/v2/flows')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    payload = {
-        'data': {
-            'type': 'flow',
-            'name': 'Pizzeria',
-            'slug': 'pizzeria',
-            'description': 'pizzeria model',
-            'enabled': True,
-        },
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']['id']
-
-
-def create_flow_field(api_key, base_url, field_name, flow_id):
-    url = urljoin(base_url, '/v2/fields')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    payload = {
-        'data': {
-            'type': 'flow',
-            'name': 'Pizzeria',
-            'slug': 'pizzeria',
-            'description': 'pizzeria model',
-            'enabled': True,
-        },
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']['id']
-
+    @timed('moltin')
+    def create_flow(self):
+        payload = {
+            'data': {
+                'type': 'flow',
+                'name': 'Pizzeria',
+                'slug': 'pizzeria',
+                'description': 'pizzeria model',
+                'enabled': True,
+            },
+        }
+        return self._request('POST', '/v2/flows', json=payload).json()['data']['id']
 
-def get_pizzerias(api_key, base_url):
-    url = urljoin(base_url, '/v2/flows/pizzeria/entries')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+    @timed('moltin')
+    def create_flow_field(self, field_name, flow_id):
+        payload = {
+            'data': {
+                'type': 'flow',
+                'name': 'Pizzeria',
+                'slug': 'pizzeria',
+                'description': 'pizzeria model',
+                'enabled': True,
+            },
+        }
+        return self._request('POST', '/v2/fields', json=payload).json()['data']['id']
 
+    @timed('moltin')
+    def get_pizzerias(self):
+        return list(self.iter_pizzerias())
 
-def save_customer_address(api_key, base_url, lat, lon, customer_id):
-    url = urljoin(base_url, '/v2/flows/customer_address/entries')
-    headers = {'Authorization': f'Bearer {api_key}'}
-    payload = {
+    @timed('moltin')
+    def save_customer_address(self, lat, lon, customer_id):
+        payload = {
             'data': {
                 'type': 'entry',
                 'lat': lat,
@@ -251,6 +346,5 @@ def save_customer_address(api_key, base_url, lat, lon, customer_id):
                 'customer_id': customer_id,
             },
         }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()['data']
+        return self._request('POST', '/v2/flows/customer_address/entries', json=payload).json()['data']
+
@@ -0,0 +1,53 @@
+import logging
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+from telegram_tools import is_not_modified
+
+logger = logging.getLogger(__name__)
+
+
+class Navigator:
+    def __init__(self, photo_cache, edit=True):
+        self.photo_cache = photo_cache
+        self.edit = edit
+
+    def show_text(self, message, text, reply_markup=None):
+        if self.edit and message.text is not None:
+            try:
+                if message.text == text.strip():
+                    return message.edit_reply_markup(reply_markup=reply_markup)
+                return message.edit_text(text, reply_markup=reply_markup)
+            except BadRequest as error:
+                if is_not_modified(error):
+                    return message
+                logger.warning('Не удалось изменить сообщение %s: %s', message.message_id, error)
+        sent_message = message.reply_text(text, reply_markup=reply_markup)
+        message.delete()
+        return sent_message
+
+    def show_photo(self, message, image_id, fetch_link, caption, reply_markup=None):
+        if self.edit and message.photo:
+            try:
+                return self.photo_cache.send_photo(
+                    lambda photo: message.edit_media(
+                        InputMediaPhoto(photo, caption=caption),
+                        reply_markup=reply_markup,
+                    ),
+                    image_id,
+                    fetch_link,
+                )
+            except BadRequest as error:
+                if is_not_modified(error):
+                    return message
+                logger.warning('Не удалось изменить сообщение %s: %s', message.message_id, error)
+        sent_message = self.photo_cache.reply_photo(
+            message,
+            image_id,
+            fetch_link,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+        message.delete()
+        return sent_message
@@ -0,0 +1,40 @@
+import logging
+
+from telegram.error import BadRequest
+
+from telegram_tools import is_not_modified
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+    def __init__(self, redis_db, key='telegram:photo_file_ids'):
+        self.redis_db = redis_db
+        self.key = key
+
+    def get(self, image_id):
+        return self.redis_db.hget(self.key, image_id)
+
+    def set(self, image_id, file_id):
+        self.redis_db.hset(self.key, image_id, file_id)
+
+    def forget(self, image_id):
+        self.redis_db.hdel(self.key, image_id)
+
+    def reply_photo(self, message, image_id, fetch_link, **kwargs):
+        return self.send_photo(lambda photo: message.reply_photo(photo=photo, **kwargs), image_id, fetch_link)
+
+    def send_photo(self, send, image_id, fetch_link):
+        file_id = self.get(image_id)
+        if file_id:
+            try:
+                return send(file_id)
+            except BadRequest as error:
+                if is_not_modified(error):
+                    raise
+                logger.warning('file_id для картинки %s устарел, отправляю по ссылке', image_id)
+                self.forget(image_id)
+
+        sent_message = send(fetch_link())
+        self.set(image_id, sent_message.photo[-1].file_id)
+        return sent_message
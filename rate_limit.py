@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate if rate else 0
+        self.burst = burst
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        if not self.interval:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now - self.interval * (self.burst - 1))
+            self._next_slot = slot + self.interval
+        return slot - now
+
+    def get_delay(self):
+        with self._lock:
+            now = time.monotonic()
+            return max(self._next_slot - now, 0)
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._next_slot = max(self._next_slot, now + seconds)
+
+    @property
+    def is_idle(self):
+        with self._lock:
+            return self._next_slot <= time.monotonic() - self.interval * (self.burst - 1)
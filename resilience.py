@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from metrics import UPSTREAM_CIRCUIT_OPEN
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+def http_error(status, message):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f'{status} {message}', response=response)
+
+
+def is_failure(error):
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = getattr(error.response, 'status_code', None)
+        return status is None or status >= 500 or status == 429
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TimeoutError))
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        UPSTREAM_CIRCUIT_OPEN.labels(service=name).set(0)
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def acquire(self):
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'{self.name} недоступен')
+            self._probing = True
+            return True
+
+    def release(self, probe, error=None):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if error is not None and not isinstance(error, Exception):
+                return
+            if error is None or not is_failure(error):
+                self.failures = 0
+                if self.opened_at is not None:
+                    self.opened_at = None
+                    UPSTREAM_CIRCUIT_OPEN.labels(service=self.name).set(0)
+                    logger.info('%s снова доступен', self.name)
+            else:
+                self.failures += 1
+                if probe or self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        logger.warning('%s недоступен, запросы временно отклоняются: %s', self.name, error)
+                    self.opened_at = time.monotonic()
+                    UPSTREAM_CIRCUIT_OPEN.labels(service=self.name).set(1)
+
+
+def get_backoff(attempt, base_delay, max_delay):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retries(function, attempts=3, breaker=None, base_delay=0.2, max_delay=2, deadline=None):
+    started_at = time.monotonic()
+    for attempt in range(attempts):
+        try:
+            if breaker is None:
+                return function()
+            probe = breaker.acquire()
+            try:
+                result = function()
+            except Exception as error:
+                breaker.release(probe, error)
+                raise
+            breaker.release(probe)
+            return result
+        except Exception as error:
+            delay = get_backoff(attempt, base_delay, max_delay)
+            out_of_time = deadline is not None and time.monotonic() - started_at + delay > deadline
+            if attempt == attempts - 1 or out_of_time or not is_failure(error):
+                raise
+            time.sleep(delay)
+
+
+async def call_with_retries_async(function, attempts=3, breaker=None, base_delay=0.2, max_delay=2, deadline=None):
+    started_at = time.monotonic()
+    for attempt in range(attempts):
+        try:
+            if breaker is None:
+                return await function()
+            probe = breaker.acquire()
+            try:
+                result = await function()
+            except BaseException as error:
+                breaker.release(probe, error)
+                raise
+            breaker.release(probe)
+            return result
+        except Exception as error:
+            delay = get_backoff(attempt, base_delay, max_delay)
+            out_of_time = deadline is not None and time.monotonic() - started_at + delay > deadline
+            if attempt == attempts - 1 or out_of_time or not is_failure(error):
+                raise
+            await asyncio.sleep(delay)
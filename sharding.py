@@ -0,0 +1,181 @@
+import bisect
+import json
+import logging
+import os
+import socket
+import time
+import zlib
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SLOT_COUNT = 64
+QUEUE_KEY = 'bot:shard:queue:{slot}'
+LEASE_KEY = 'bot:shard:lease:{slot}'
+WORKERS_KEY = 'bot:shard:workers'
+
+RENEW_LEASE = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RELEASE_LEASE = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+def stable_hash(value):
+    return zlib.crc32(str(value).encode())
+
+
+def get_slot(chat_id, slot_count=SLOT_COUNT):
+    return stable_hash(chat_id) % slot_count
+
+
+def get_shard_key(payload):
+    for field in payload.values():
+        if not isinstance(field, dict):
+            continue
+        chat = field.get('chat') or (field.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if 'from' in field:
+            return field['from']['id']
+    return 0
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        self._ring = sorted(
+            (stable_hash(f'{node}#{replica}'), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [node_hash for node_hash, _ in self._ring]
+
+    def get_node(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, stable_hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class ShardRouter:
+    def __init__(self, redis_db, slot_count=SLOT_COUNT):
+        self.redis_db = redis_db
+        self.slot_count = slot_count
+
+    def route(self, payload):
+        slot = get_slot(get_shard_key(payload), self.slot_count)
+        self.redis_db.rpush(QUEUE_KEY.format(slot=slot), json.dumps(payload))
+
+
+def run_polling_router(bot, router, stop_event, timeout=30):
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout)
+        except Exception:
+            logger.exception('Не удалось получить обновления')
+            stop_event.wait(1)
+            continue
+        for update in updates:
+            router.route(update.to_dict())
+            offset = update.update_id + 1
+
+
+class ShardWorker:
+    def __init__(self, redis_db, dispatcher, conversation_handler, slot_count=SLOT_COUNT,
+                 worker_id=None, lease_ttl=15):
+        self.redis_db = redis_db
+        self.dispatcher = dispatcher
+        self.conversation_handler = conversation_handler
+        self.persistence = dispatcher.persistence
+        self.slot_count = slot_count
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_ttl = lease_ttl
+        self.owned = set()
+        self._next_rebalance = 0
+        self._rotation = 0
+        self._renew_lease = redis_db.register_script(RENEW_LEASE)
+        self._release_lease = redis_db.register_script(RELEASE_LEASE)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            if time.monotonic() >= self._next_rebalance:
+                self.rebalance()
+                self._next_rebalance = time.monotonic() + self.lease_ttl / 3
+            if not self.owned:
+                stop_event.wait(1)
+                continue
+            item = self.redis_db.blpop(self._queue_keys(), timeout=1)
+            if item:
+                self._process(*item)
+        self.leave()
+
+    def rebalance(self):
+        now = time.time()
+        with self.redis_db.pipeline() as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - self.lease_ttl)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            workers = pipe.execute()[-1]
+        ring = HashRing(workers)
+        desired = {slot for slot in range(self.slot_count) if ring.get_node(slot) == self.worker_id}
+
+        for slot in list(self.owned):
+            lease_key = LEASE_KEY.format(slot=slot)
+            if slot not in desired:
+                self._drop_slot(slot)
+                self._release_lease(keys=[lease_key], args=[self.worker_id])
+            elif not self._renew_lease(keys=[lease_key], args=[self.worker_id, self.lease_ttl * 1000]):
+                logger.warning('Потеряна аренда шарда %s', slot)
+                self._drop_slot(slot)
+
+        for slot in desired - self.owned:
+            lease_key = LEASE_KEY.format(slot=slot)
+            if self.redis_db.set(lease_key, self.worker_id, nx=True, px=self.lease_ttl * 1000):
+                self._load_slot(slot)
+
+    def leave(self):
+        self.redis_db.zrem(WORKERS_KEY, self.worker_id)
+        for slot in list(self.owned):
+            self._drop_slot(slot)
+            self._release_lease(keys=[LEASE_KEY.format(slot=slot)], args=[self.worker_id])
+
+    def _queue_keys(self):
+        slots = sorted(self.owned)
+        self._rotation = (self._rotation + 1) % len(slots)
+        slots = slots[self._rotation:] + slots[:self._rotation]
+        return [QUEUE_KEY.format(slot=slot) for slot in slots]
+
+    def _process(self, queue_key, payload):
+        update = Update.de_json(json.loads(payload), self.dispatcher.bot)
+        self.dispatcher.process_update(update)
+
+    def _load_slot(self, slot):
+        name = self.conversation_handler.name
+        user_data, chat_data, conversations = self.persistence.load_slot(slot, [name])
+        self.dispatcher.user_data.update(user_data)
+        self.dispatcher.chat_data.update(chat_data)
+        self.conversation_handler.conversations.update(conversations[name])
+        self.owned.add(slot)
+        logger.info('Шард %s закреплён за %s', slot, self.worker_id)
+
+    def _drop_slot(self, slot):
+        self.owned.discard(slot)
+        if hasattr(self.dispatcher, 'drain'):
+            self.dispatcher.drain(lambda chat_id: get_slot(chat_id, self.slot_count) == slot)
+        self.persistence.drop_slot(slot)
+        for storage in (self.dispatcher.user_data, self.dispatcher.chat_data):
+            for key in [key for key in storage if get_slot(key, self.slot_count) == slot]:
+                del storage[key]
+        conversations = self.conversation_handler.conversations
+        for key in [key for key in conversations if get_slot(key[0], self.slot_count) == slot]:
+            del conversations[key]
+        logger.info('Шард %s освобождён', slot)
@@ -0,0 +1,251 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+from metrics import observe_upstream, TELEGRAM_FLOOD_WAITS, TELEGRAM_OUTBOX_DEPTH, TELEGRAM_OUTBOX_LATENCY
+from rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER = 'customer'
+NOTIFICATION = 'notification'
+PRIORITIES = (CUSTOMER, NOTIFICATION)
+UNQUEUED_METHODS = ('get', 'answer', 'sendChatAction')
+DETACHED_METHODS = {'deleteMessage'}
+BATCH_METHODS = {'deleteMessage': ('deleteMessages', 'message_id', 'message_ids')}
+CHAT_UNLIMITED_METHODS = {'deleteMessage'}
+MAX_BATCH_SIZE = 100
+
+_context = threading.local()
+
+
+@contextmanager
+def notification_priority(detached=True):
+    previous = get_priority(), is_detached()
+    _context.priority = NOTIFICATION
+    _context.detached = detached
+    try:
+        yield
+    finally:
+        _context.priority, _context.detached = previous
+
+
+def get_priority():
+    return getattr(_context, 'priority', CUSTOMER)
+
+
+def is_detached():
+    return getattr(_context, 'detached', False)
+
+
+def is_not_modified(error):
+    return 'message is not modified' in error.message.lower()
+
+
+def is_group_chat(chat_id):
+    try:
+        return int(chat_id) < 0
+    except ValueError:
+        return True
+
+
+class InstrumentedRequest(Request):
+    def post(self, url, data, timeout=None):
+        with observe_upstream('telegram', url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+class OutboundMessage:
+    def __init__(self, number, method, url, data, timeout, priority):
+        self.rank = (PRIORITIES.index(priority), number)
+        self.method = method
+        self.url = url
+        self.data = data
+        self.timeout = timeout
+        self.priority = priority
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+        self.flood_waits = 0
+
+
+class ChatOutbox:
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.messages = deque()
+        self.busy = False
+
+
+class TelegramOutbox:
+    def __init__(self, send, rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, workers=4,
+                 max_flood_retries=3, max_flood_wait=30):
+        self._send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_flood_retries = max_flood_retries
+        self.max_flood_wait = max_flood_wait
+        self._limiter = RateLimiter(rate, burst=max(int(rate), 1))
+        self._chats = {}
+        self._numbers = itertools.count()
+        self._pending = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='telegram-send')
+        self._thread = threading.Thread(target=self._run, name='telegram-outbox', daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        with self._condition:
+            return self._pending
+
+    def put(self, chat_id, method, url, data, timeout=None, priority=CUSTOMER):
+        message = OutboundMessage(next(self._numbers), method, url, data, timeout, priority)
+        with self._condition:
+            outbox = self._chats.get(chat_id)
+            if outbox is None:
+                if is_group_chat(chat_id):
+                    limiter = RateLimiter(self.group_rate)
+                else:
+                    limiter = RateLimiter(self.chat_rate, burst=self.chat_burst)
+                outbox = self._chats[chat_id] = ChatOutbox(limiter)
+            outbox.messages.append(message)
+            self._pending += 1
+            TELEGRAM_OUTBOX_DEPTH.labels(priority=priority).inc()
+            self._condition.notify_all()
+        return message.future
+
+    def stop(self, timeout=10):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+            if not self._condition.wait_for(lambda: not self._pending, timeout):
+                logger.warning('Не отправлено сообщений в Telegram: %s', self._pending)
+        self._executor.shutdown(wait=False)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                outbox, wait = self._pick()
+                while outbox is None:
+                    if self._stopped and not self._pending:
+                        return
+                    self._condition.wait(wait)
+                    outbox, wait = self._pick()
+                messages = self._take(outbox)
+            delay = self._limiter.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            self._executor.submit(self._deliver, outbox, messages)
+
+    def _pick(self):
+        chosen = None
+        wait = None
+        for chat_id, outbox in list(self._chats.items()):
+            if outbox.busy:
+                continue
+            if not outbox.messages:
+                if outbox.limiter.is_idle:
+                    del self._chats[chat_id]
+                continue
+            delay = 0
+            if outbox.messages[0].method not in CHAT_UNLIMITED_METHODS:
+                delay = outbox.limiter.get_delay()
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+            elif chosen is None or outbox.messages[0].rank < chosen.messages[0].rank:
+                chosen = outbox
+        return chosen, wait
+
+    def _take(self, outbox):
+        messages = [outbox.messages.popleft()]
+        if messages[0].method in BATCH_METHODS:
+            while (
+                outbox.messages
+                and outbox.messages[0].method == messages[0].method
+                and outbox.messages[0].data.keys() == messages[0].data.keys()
+                and len(messages) < MAX_BATCH_SIZE
+            ):
+                messages.append(outbox.messages.popleft())
+        outbox.busy = True
+        if messages[0].method not in CHAT_UNLIMITED_METHODS:
+            outbox.limiter.reserve()
+        return messages
+
+    def _deliver(self, outbox, messages):
+        head = messages[0]
+        url, data = head.url, head.data
+        if len(messages) > 1:
+            batch_method, field, batch_field = BATCH_METHODS[head.method]
+            url = f'{url.rsplit("/", 1)[0]}/{batch_method}'
+            data = {key: value for key, value in data.items() if key != field}
+            data[batch_field] = [message.data[field] for message in messages]
+        try:
+            result = self._send(url, data, head.timeout)
+        except RetryAfter as error:
+            TELEGRAM_FLOOD_WAITS.inc()
+            outbox.limiter.pause(error.retry_after)
+            if head.flood_waits < self.max_flood_retries and error.retry_after <= self.max_flood_wait:
+                self._requeue(outbox, messages)
+            else:
+                self._complete(outbox, messages, error=error)
+        except Exception as error:
+            self._complete(outbox, messages, error=error)
+        else:
+            self._complete(outbox, messages, result=result)
+
+    def _requeue(self, outbox, messages):
+        with self._condition:
+            for message in reversed(messages):
+                message.flood_waits += 1
+                outbox.messages.appendleft(message)
+            outbox.busy = False
+            self._condition.notify_all()
+
+    def _complete(self, outbox, messages, result=None, error=None):
+        sent_at = time.perf_counter()
+        for message in messages:
+            TELEGRAM_OUTBOX_DEPTH.labels(priority=message.priority).dec()
+            TELEGRAM_OUTBOX_LATENCY.labels(priority=message.priority).observe(sent_at - message.queued_at)
+            if error is None:
+                message.future.set_result(result)
+            else:
+                message.future.set_exception(error)
+        with self._condition:
+            outbox.busy = False
+            self._pending -= len(messages)
+            self._condition.notify_all()
+
+
+def log_detached_failure(method, chat_id, future):
+    error = future.exception()
+    if error is not None:
+        logger.warning('Не удалось выполнить %s в чате %s: %s', method, chat_id, error)
+
+
+class QueuedRequest(InstrumentedRequest):
+    def __init__(self, *args, rate=30, chat_rate=1, chat_burst=3, send_workers=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = TelegramOutbox(super().post, rate, chat_rate, chat_burst, workers=send_workers)
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if 'chat_id' not in data or method.startswith(UNQUEUED_METHODS):
+            return super().post(url, data, timeout=timeout)
+        priority = get_priority()
+        future = self.outbox.put(data['chat_id'], method, url, data, timeout, priority)
+        if method in DETACHED_METHODS or is_detached():
+            future.add_done_callback(partial(log_detached_failure, method, data['chat_id']))
+            return True
+        return future.result()
@@ -0,0 +1,21 @@
+from distance_handling import PizzeriaLocator
+
+
+def make_pizzeria(pizzeria_id, lat, lon):
+    return {'id': pizzeria_id, 'Alias': pizzeria_id, 'Latitude': str(lat), 'Longitude': str(lon)}
+
+
+def test_nearest_with_equal_distance_branches():
+    pizzerias = [
+        make_pizzeria('first', 55.75, 37.61),
+        make_pizzeria('second', 55.75, 37.61),
+        make_pizzeria('far', 55.9, 37.4),
+    ]
+    locator = PizzeriaLocator(lambda: pizzerias)
+
+    nearest = locator.nearest(('55.76', '37.62'), k=3)
+    nearest_place = locator.find_nearest(('55.76', '37.62'))
+
+    assert {pizzeria['id'] for pizzeria, _ in nearest[:2]} == {'first', 'second'}
+    assert nearest[2][0]['id'] == 'far'
+    assert nearest_place['id'] in ('first', 'second')
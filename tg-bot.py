@@ -1,14 +1,18 @@
 import logging
+import multiprocessing
+import signal
+import threading
 from enum import Enum, auto
 from textwrap import dedent
 from functools import partial
+from math import ceil
+from queue import Queue
+from urllib.parse import urljoin
 
 import redis
 import requests
 from environs import Env
-from geopy import distance
-from redispersistence.persistence import RedisPersistence
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, LabeledPrice
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update, LabeledPrice
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -17,22 +21,26 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
     CallbackQueryHandler,
+    JobQueue,
     PreCheckoutQueryHandler,
 )
 
-from distance_handling import fetch_coordinates, get_distance
-from moltin_tools import (
-    get_api_key,
-    get_products,
-    get_cart,
-    add_product_to_cart,
-    get_product,
-    fetch_image,
-    remove_item_from_cart,
-    create_customer,
-    get_pizzerias,
-    save_customer_address,
-)
+from cart_mirror import CartMirror
+from bot_persistence import ShardedRedisPersistence
+from catalog_cache import CatalogCache
+from catalog_snapshot import CatalogSnapshot
+from chat_executor import ChatSerialDispatcher, ChatSerialExecutor
+from delayed_jobs import DelayedJobs
+from delivery_zones import DeliveryZoneLocator, get_delivery_cost, load_zones
+from distance_handling import geocode, GeocodeCache, GEOCODER_URL, PizzeriaLocator
+from moltin_tools import MoltinClient, MoltinTokenProvider
+from navigation import Navigator
+from metrics import instrument_callback, instrument_conversation, start_metrics_server
+from photo_cache import PhotoCache
+from resilience import CircuitBreaker
+from sharding import run_polling_router, ShardRouter, ShardWorker, SLOT_COUNT
+from telegram_tools import notification_priority, QueuedRequest
+from webhook import run_webhook, set_webhook, WebhookServer
 
 logger = logging.getLogger(__name__)
 
@@ -63,14 +71,13 @@ def precheckout_callback(update, context):
         query.answer(ok=False, error_message="Something went wrong...")
     else:
         query.answer(ok=True)
-    return States.handle_user_reply
 
 
-def successful_payment_callback(update, context, moltin_base_url, moltin_api_key):
+def successful_payment_callback(update, context, moltin):
     user_id = update.effective_chat.id
     customer_location = context.user_data['order_info']['coordinates']
-    save_customer_address(moltin_api_key, moltin_base_url, customer_location[0], customer_location[1], user_id)
-    create_customer(moltin_base_url, moltin_api_key, user_id)
+    moltin.save_customer_address(customer_location[0], customer_location[1], user_id)
+    moltin.create_customer(user_id)
     keyboard = [
         [InlineKeyboardButton('Меню', callback_data='Меню')],
     ]
@@ -83,27 +90,40 @@ def successful_payment_callback(update, context, moltin_base_url, moltin_api_key
 
 
 
-def send_notification_customer(context):
-    bot = context.bot
-    user_id = context.job.context
+def send_notification_customer(bot, user_id):
     text = dedent('''
     Приятного аппетита! *место для рекламы*
     *сообщение что делать если пицца не пришла*
     ''')
-    bot.send_message(
-        text=text,
-        chat_id=user_id
-    )
+    with notification_priority(detached=False):
+        bot.send_message(
+            text=text,
+            chat_id=user_id
+        )
 
     
-def start(update: Update, context: CallbackContext, base_url, api_key) -> int:
+def start(update: Update, context: CallbackContext, catalog, page_size, navigator) -> int:
     query = update.callback_query
 
-    products = get_products(base_url, api_key)
+    page = context.user_data.get('menu_page', 0)
+    if query and query.data.startswith(f'{Transitions.menu}|'):
+        page = int(query.data.split('|')[1])
+    products = catalog.get_products()
+    pages_count = max(ceil(len(products) / page_size), 1)
+    page = min(page, pages_count - 1)
+    context.user_data['menu_page'] = page
+
     keyboard = [
         [InlineKeyboardButton(product['name'], callback_data=product['id'])]
-        for product in products
+        for product in products[page * page_size:(page + 1) * page_size]
     ]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton('←', callback_data=f'{Transitions.menu}|{page - 1}'))
+    if page < pages_count - 1:
+        navigation.append(InlineKeyboardButton('→', callback_data=f'{Transitions.menu}|{page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
     keyboard.append(
         [
             InlineKeyboardButton('Корзина', callback_data=str(Transitions.cart)),
@@ -112,11 +132,7 @@ def start(update: Update, context: CallbackContext, base_url, api_key) -> int:
     reply_markup = InlineKeyboardMarkup(keyboard)
     if query:
         query.answer()
-        query.message.reply_text(
-            text='Вкусная питса:',
-            reply_markup=reply_markup
-        )
-        query.message.delete()
+        navigator.show_text(query.message, 'Вкусная питса:', reply_markup)
     else:
         update.message.reply_text(
             text='Вкусная питса:',
@@ -134,12 +150,12 @@ def cancel(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
-def handle_menu(update: Update, context: CallbackContext, base_url, api_key) -> int:
+def handle_menu(update: Update, context: CallbackContext, catalog, navigator) -> int:
     query = update.callback_query
     query.answer()
     product_id = query['data']
-    product = get_product(base_url, api_key, product_id)
-    image_link = fetch_image(base_url, api_key, product['relationships']['main_image']['data']['id'])
+    product = catalog.get_product(product_id)
+    image_id = product['relationships']['main_image']['data']['id']
     message = dedent(f'''
         {product["name"]}
         {product["description"]}
@@ -155,34 +171,36 @@ def handle_menu(update: Update, context: CallbackContext, base_url, api_key) ->
         ],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_photo(
-        photo=image_link,
+    navigator.show_photo(
+        query.message,
+        image_id,
+        partial(catalog.fetch_image, image_id),
         caption=message,
         reply_markup=reply_markup,
     )
-    query.message.delete()
 
     return States.handle_description
 
 
-def handle_description(update: Update, context: CallbackContext, base_url, api_key) -> int:
+def handle_description(update: Update, context: CallbackContext, carts) -> int:
     query = update.callback_query
     query.answer()
     quantity, product_id = query['data'].split('|')
     user_id = update.effective_chat.id
-    add_product_to_cart(base_url, api_key, product_id, quantity, user_id)
+    carts.add(user_id, product_id, quantity)
 
     return States.handle_description
 
 
-def handle_cart(update: Update, context: CallbackContext, base_url, api_key) -> int:
+def handle_cart(update: Update, context: CallbackContext, carts, navigator) -> int:
     query = update.callback_query
     query.answer()
     user_id = update.effective_chat.id
     if '|' in query['data']:
         action, product_id = query['data'].split('|')
-        remove_item_from_cart(base_url, api_key, user_id, product_id)
-    cart = get_cart(base_url, api_key, user_id)
+        cart = carts.remove(user_id, product_id)
+    else:
+        cart = carts.get(user_id)
     fish_names_ids = {}
     total_cost = 0
     items_info = []
@@ -215,17 +233,12 @@ def handle_cart(update: Update, context: CallbackContext, base_url, api_key) ->
         ],
     )
     reply_markup = InlineKeyboardMarkup(keyboard)
-
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    query.message.delete()
+    navigator.show_text(query.message, message, reply_markup)
 
     return States.handle_cart
 
 
-def handle_order(update: Update, context: CallbackContext) -> int:
+def handle_order(update: Update, context: CallbackContext, navigator) -> int:
     query = update.callback_query
     query.answer()
 
@@ -237,18 +250,12 @@ def handle_order(update: Update, context: CallbackContext) -> int:
         InlineKeyboardButton('Корзина', callback_data=str(Transitions.cart)),
     ],
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
-        text=message,
-        reply_markup=reply_markup,
-    )
-    query.message.delete()
+    navigator.show_text(query.message, message, reply_markup)
 
     return States.waiting_coordinates
 
 
-def handle_location(update: Update, context: CallbackContext, base_url, geocoder_api_key, moltin_api_key) -> int:
-
-    pizzerias = get_pizzerias(moltin_api_key, base_url)
+def handle_location(update: Update, context: CallbackContext, zones, geocoder) -> int:
     lon = None
     lat = None
     try:
@@ -260,10 +267,10 @@ def handle_location(update: Update, context: CallbackContext, base_url, geocoder
         customer_location = (update.message.location.latitude, update.message.location.longitude)
     else:
         try:
-            customer_location = fetch_coordinates(geocoder_api_key, update.message.text.strip())
+            customer_location = geocoder.fetch_coordinates(update.message.text.strip())
             if not customer_location:
                 raise requests.exceptions.HTTPError
-        except requests.exceptions.HTTPError:
+        except requests.exceptions.RequestException:
             message = f'Не удалось уточнить координаты по адресу {update.message.text.strip()}\n попробуйте снова'
             update.message.reply_text(
                 text=message,
@@ -277,32 +284,26 @@ def handle_location(update: Update, context: CallbackContext, base_url, geocoder
         [InlineKeyboardButton('Самовывоз', callback_data=str(Transitions.pickup))],
     ]
 
-    for pizzeria in pizzerias:
-        pizzeria['distance'] = distance.distance(
-            (pizzeria['Latitude'], pizzeria['Longitude']), customer_location
-        ).km
-    nearest_place = min(pizzerias, key=get_distance)
+    nearest_place, tier = zones.locate(customer_location)
+    delivery_cost = get_delivery_cost(tier) or 0
     message += f'\nБлижайшая к Вам пиццерия: {nearest_place["Address"]}'
-    if nearest_place['distance'] < 0.5:
+    if tier == 0:
         message += '\nЗаберете пиццу сами или принести её к Вам?'
         keyboard.append(
             [InlineKeyboardButton('Доставка', callback_data=str(Transitions.deliver))]
         )
-    elif nearest_place['distance'] < 5.0:
-        message += '\nМожем привезти на самокате за 100р, но можете прийти сами'
-        delivery_cost = 100
+    elif tier == 1:
+        message += f'\nМожем привезти на самокате за {delivery_cost}р, но можете прийти сами'
         keyboard.append(
             [InlineKeyboardButton('Доставка', callback_data=str(Transitions.deliver))]
         )
-    elif nearest_place['distance'] < 20.0:
-        message += '\nЕхать к Вам не меньше получаса, придется доплатить 300р. Или заедете сами?'
-        delivery_cost = 300
+    elif tier == 2:
+        message += f'\nЕхать к Вам не меньше получаса, придется доплатить {delivery_cost}р. Или заедете сами?'
         keyboard.append(
             [InlineKeyboardButton('Доставка', callback_data=str(Transitions.deliver))]
         )
     else:
         message += '\nТак далеко мы не повезем, только если приедете сами.'
-        delivery_cost = 0
 
     context.user_data['order_info'] = {
         'coordinates': customer_location,
@@ -319,12 +320,12 @@ def handle_location(update: Update, context: CallbackContext, base_url, geocoder
     return next_state
 
 
-def handle_delivery(update: Update, context: CallbackContext, delivery, moltin_base_url, moltin_api_key, payment_token) -> int:
+def handle_delivery(update: Update, context: CallbackContext, delivery, carts, payment_token, jobs) -> int:
     query = update.callback_query
     query.answer()
 
     user_id = update.effective_chat.id
-    cart = get_cart(moltin_base_url, moltin_api_key, user_id)
+    cart = carts.reconcile(user_id)
     total_cost = 0
     items_info = []
     for item in cart['data']:
@@ -345,15 +346,15 @@ def handle_delivery(update: Update, context: CallbackContext, delivery, moltin_b
     total_cost += delivery_cost
     order_info = f'{"".join(items_info)}\nДоставка {delivery_cost}руб.\nК оплате {total_cost} руб.'
     if delivery:
+        with notification_priority():
+            context.bot.send_message(context.user_data['order_info']['deliveryman_id'], order_info)
+            context.bot.send_location(
+                context.user_data['order_info']['deliveryman_id'],
+                latitude=context.user_data['order_info']['coordinates'][0],
+                longitude=context.user_data['order_info']['coordinates'][1]
+            )
 
-        context.bot.send_message(context.user_data['order_info']['deliveryman_id'], order_info)
-        context.bot.send_location(
-            context.user_data['order_info']['deliveryman_id'],
-            latitude=context.user_data['order_info']['coordinates'][0],
-            longitude=context.user_data['order_info']['coordinates'][1]
-        )
-
-    context.job_queue.run_once(send_notification_customer, 3600, context=user_id)
+    jobs.schedule('notify_customer', 3600, user_id, key=f'notify_customer:{query.id}')
 
     message = f'Всё готово, осталось только оплатить\nК оплате {total_cost + delivery_cost} руб.'
 
@@ -375,108 +376,174 @@ def handle_delivery(update: Update, context: CallbackContext, delivery, moltin_b
     return States.handle_user_reply
 
 
-def main():
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
+def create_redis(env):
+    return redis.Redis(
+        host=env('REDIS_HOST'),
+        port=env('REDIS_PORT'),
+        db=env('REDIS_DB', 0),
+        username=env('REDIS_USERNAME'),
+        password=env('REDIS_PASSWORD'),
+        decode_responses=True
     )
 
-    env = Env()
-    env.read_env()
+
+def build_updater(env, redis_db, persistence, persistent=False):
     tg_token = env('TG_TOKEN')
-    redis_host = env('REDIS_HOST')
-    redis_port = env('REDIS_PORT')
-    redis_db = env('REDIS_DB', 0)
-    redis_username = env('REDIS_USERNAME')
-    redis_password = env('REDIS_PASSWORD')
     moltin_client_id = env('MOLTIN_CLIENT_ID')
     moltin_client_secret = env('MOLTIN_CLIENT_SECRET')
     moltin_base_url = env('MOLTIN_BASE_URL')
     geocoder_api_key = env('GEOCODER_API_KEY')
+    geocoder_url = env('GEOCODER_URL', GEOCODER_URL)
+    tg_api_url = env('TG_API_URL', None)
     payment_token = env('PAYMENT_TOKEN')
-    moltin_api_key = get_api_key(moltin_base_url, moltin_client_id, moltin_client_secret)
-
-    redis_db = redis.Redis(
-        host=redis_host,
-        port=redis_port,
-        db=redis_db,
-        username=redis_username,
-        password=redis_password,
-        decode_responses=True
+    moltin_pool_size = env.int('MOLTIN_POOL_SIZE', 10)
+    async_io = env.bool('ASYNC_IO', False)
+    catalog_ttl = env.int('CATALOG_TTL', 600)
+    catalog_size = env.int('CATALOG_SIZE', 512)
+    menu_page_size = env.int('MENU_PAGE_SIZE', 8)
+    pizzerias_refresh_interval = env.int('PIZZERIAS_REFRESH_INTERVAL', 300)
+    cart_reconcile_interval = env.int('CART_RECONCILE_INTERVAL', 300)
+    geocode_cache_ttl = env.int('GEOCODE_CACHE_TTL', 30 * 24 * 3600)
+    geocode_negative_ttl = env.int('GEOCODE_NEGATIVE_TTL', 600)
+    bot_workers = env.int('BOT_THREADS', 8)
+    handler_queue_size = env.int('HANDLER_QUEUE_SIZE', 1000)
+    tg_rate_limit = env.float('TG_RATE_LIMIT', 30)
+    tg_chat_rate_limit = env.float('TG_CHAT_RATE_LIMIT', 1)
+    tg_send_threads = env.int('TG_SEND_THREADS', 4)
+    delivery_zones_file = env('DELIVERY_ZONES_FILE', None)
+    catalog_snapshot_file = env('CATALOG_SNAPSHOT_FILE', None)
+    edit_messages = env.bool('EDIT_MESSAGES', True)
+    circuit_failure_threshold = env.int('CIRCUIT_FAILURE_THRESHOLD', 5)
+    circuit_reset_timeout = env.int('CIRCUIT_RESET_TIMEOUT', 30)
+    moltin_breaker = CircuitBreaker('moltin', circuit_failure_threshold, circuit_reset_timeout)
+    geocoder_breaker = CircuitBreaker('geocoder', circuit_failure_threshold, circuit_reset_timeout)
+    token_provider = MoltinTokenProvider(moltin_base_url, moltin_client_id, moltin_client_secret)
+    token_provider.start_in_background()
+    if async_io:
+        from async_tools import AsyncGeocoder, AsyncMoltinClient, AsyncRuntime
+
+        runtime = AsyncRuntime()
+        runtime.start()
+        moltin = runtime.blocking(
+            AsyncMoltinClient(moltin_base_url, token_provider, pool_size=moltin_pool_size, breaker=moltin_breaker)
+        )
+        geocode_lookup = runtime.blocking(
+            AsyncGeocoder(geocoder_api_key, url=geocoder_url, breaker=geocoder_breaker),
+            service='geocoder',
+        ).geocode
+    else:
+        moltin = MoltinClient(moltin_base_url, token_provider, pool_size=moltin_pool_size, breaker=moltin_breaker)
+        geocode_lookup = partial(geocode, geocoder_api_key, url=geocoder_url, breaker=geocoder_breaker)
+
+    catalog = CatalogCache(moltin, ttl=catalog_ttl, max_entries=catalog_size)
+    catalog.listen_invalidations(redis_db)
+    navigator = Navigator(PhotoCache(redis_db), edit=edit_messages)
+    carts = CartMirror(redis_db, moltin, reconcile_interval=cart_reconcile_interval)
+    locator = PizzeriaLocator(moltin.get_pizzerias, refresh_interval=pizzerias_refresh_interval)
+    snapshot = CatalogSnapshot(catalog, locator, catalog_snapshot_file)
+    snapshot.load()
+    locator.start()
+    snapshot.start()
+    zones = DeliveryZoneLocator(locator, load_zones(delivery_zones_file) if delivery_zones_file else None)
+    geocoder = GeocodeCache(
+        redis_db,
+        geocoder_api_key,
+        ttl=geocode_cache_ttl,
+        negative_ttl=geocode_negative_ttl,
+        lookup=geocode_lookup,
     )
-    persistence = RedisPersistence(redis_db)
-    updater = Updater(token=tg_token, persistence=persistence)
 
-    dispatcher = updater.dispatcher
+    request = QueuedRequest(
+        con_pool_size=bot_workers * 2 + tg_send_threads + 4,
+        rate=tg_rate_limit,
+        chat_rate=tg_chat_rate_limit,
+        send_workers=tg_send_threads,
+    )
+    bot = Bot(tg_token, base_url=tg_api_url, request=request)
+    jobs = DelayedJobs(redis_db, {'notify_customer': partial(send_notification_customer, bot)})
+    jobs.start()
+    job_queue = JobQueue()
+    dispatcher = ChatSerialDispatcher(
+        bot,
+        Queue(),
+        workers=0,
+        job_queue=job_queue,
+        persistence=persistence,
+        executor=ChatSerialExecutor(bot_workers, handler_queue_size),
+    )
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler(
                 'start',
-                partial(start, base_url=moltin_base_url, api_key=moltin_api_key)
+                partial(start, catalog=catalog, page_size=menu_page_size, navigator=navigator)
             ),
         ],
         states={
             States.handle_menu: [
                 CallbackQueryHandler(
-                    partial(handle_cart, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(handle_cart, carts=carts, navigator=navigator),
                     pattern=f'^{Transitions.cart}$'
                 ),
                 CallbackQueryHandler(
-                    partial(handle_menu, base_url=moltin_base_url, api_key=moltin_api_key)
+                    partial(start, catalog=catalog, page_size=menu_page_size, navigator=navigator),
+                    pattern=fr'^{Transitions.menu}\|\d+$'
+                ),
+                CallbackQueryHandler(
+                    partial(handle_menu, catalog=catalog, navigator=navigator)
                 ),
             ],
             States.handle_description: [
                 CallbackQueryHandler(
-                    partial(start, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(start, catalog=catalog, page_size=menu_page_size, navigator=navigator),
                     pattern=f'^{Transitions.menu}$'
                 ),
                 CallbackQueryHandler(
-                    partial(handle_cart, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(handle_cart, carts=carts, navigator=navigator),
                     pattern=f'^{Transitions.cart}$'
                 ),
                 CallbackQueryHandler(
-                    partial(handle_description, base_url=moltin_base_url, api_key=moltin_api_key)
+                    partial(handle_description, carts=carts)
                 ),
             ],
             States.handle_cart: [
                 CallbackQueryHandler(
-                    partial(start, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(start, catalog=catalog, page_size=menu_page_size, navigator=navigator),
                     pattern=f'^{Transitions.menu}$'
                 ),
                 CallbackQueryHandler(
-                    handle_order,
+                    partial(handle_order, navigator=navigator),
                     pattern=f'^{Transitions.order}$'
                 ),
                 CallbackQueryHandler(
-                    partial(handle_cart, base_url=moltin_base_url, api_key=moltin_api_key)
+                    partial(handle_cart, carts=carts, navigator=navigator)
                 ),
             ],
             States.waiting_coordinates: [
                 CallbackQueryHandler(
-                    partial(start, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(start, catalog=catalog, page_size=menu_page_size, navigator=navigator),
                     pattern=f'^{Transitions.menu}$'
                 ),
                 CallbackQueryHandler(
-                    partial(handle_cart, base_url=moltin_base_url, api_key=moltin_api_key),
+                    partial(handle_cart, carts=carts, navigator=navigator),
                     pattern=f'^{Transitions.cart}$'
                 ),
                 MessageHandler(
                     Filters.text,
                     partial(
                         handle_location,
-                        base_url=moltin_base_url,
-                        geocoder_api_key=geocoder_api_key,
-                        moltin_api_key=moltin_api_key,
+                        zones=zones,
+                        geocoder=geocoder,
                     )
                 ),
                 MessageHandler(
                     Filters.location,
                     partial(
                         handle_location,
-                        base_url=moltin_base_url,
-                        geocoder_api_key=geocoder_api_key,
-                        moltin_api_key=moltin_api_key,
+                        zones=zones,
+                        geocoder=geocoder,
                     )
                 ),
             ],
@@ -485,9 +552,9 @@ def main():
                     partial(
                         handle_delivery,
                         delivery=False,
-                        moltin_api_key=moltin_api_key,
-                        moltin_base_url=moltin_base_url,
+                        carts=carts,
                         payment_token=payment_token,
+                        jobs=jobs,
                     ),
                     pattern=f'^{Transitions.pickup}$'
                 ),
@@ -495,18 +562,17 @@ def main():
                     partial(
                         handle_delivery,
                         delivery=True,
-                        moltin_api_key=moltin_api_key,
-                        moltin_base_url=moltin_base_url,
+                        carts=carts,
                         payment_token=payment_token,
+                        jobs=jobs,
                     ),
                     pattern=f'^{Transitions.deliver}$'
                 ),
             ],
             States.handle_user_reply: [
-                PreCheckoutQueryHandler(precheckout_callback),
                 MessageHandler(
                     Filters.successful_payment,
-                    successful_payment_callback
+                    partial(successful_payment_callback, moltin=moltin)
                 ),
             ],
         },
@@ -514,12 +580,132 @@ def main():
             CommandHandler('cancel', partial(cancel)),
             CommandHandler('start', partial(cancel)),
         ],
+        name='pizzeria',
+        persistent=persistent,
     )
+    instrument_conversation(conv_handler)
 
     dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(PreCheckoutQueryHandler(instrument_callback(precheckout_callback, 'payment')))
+    return updater, conv_handler
+
+
+def create_webhook_server(env, bot):
+    webhook_url = env('WEBHOOK_URL', None)
+    if not webhook_url:
+        return None
+    webhook_path = env('WEBHOOK_PATH', '/telegram')
+    webhook_secret = env('WEBHOOK_SECRET', None)
+    set_webhook(bot, urljoin(webhook_url, webhook_path), webhook_secret)
+    return WebhookServer(
+        env('WEBHOOK_LISTEN', '127.0.0.1'),
+        env.int('WEBHOOK_PORT', 8443),
+        webhook_path,
+        webhook_secret,
+    )
+
+
+def wait_for_stop_signal():
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    return stop_event
+
+
+def start_metrics(env, offset=0):
+    metrics_port = env.int('METRICS_PORT', 0)
+    if metrics_port:
+        start_metrics_server(metrics_port + offset, env('METRICS_LISTEN', '127.0.0.1'))
+
+
+def run_single(env):
+    start_metrics(env)
+    redis_db = create_redis(env)
+    persistence = ShardedRedisPersistence(
+        redis_db,
+        States,
+        env.int('SHARD_SLOTS', SLOT_COUNT),
+        flush_interval=env.float('PERSISTENCE_FLUSH_INTERVAL', 0.5),
+    )
+    updater, _ = build_updater(env, redis_db, persistence, persistent=True)
+    server = create_webhook_server(env, updater.bot)
+    if server:
+        run_webhook(updater, server)
+    else:
+        updater.start_polling()
+        updater.idle()
+
 
-    updater.start_polling()
-    updater.idle()
+def run_router(env):
+    redis_db = create_redis(env)
+    router = ShardRouter(redis_db, env.int('SHARD_SLOTS', SLOT_COUNT))
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(env, number + 1), name=f'bot-worker-{number}')
+        for number in range(env.int('BOT_WORKERS', 0))
+    ]
+    for worker in workers:
+        worker.start()
+    start_metrics(env)
+
+    bot = Bot(env('TG_TOKEN'), base_url=env('TG_API_URL', None))
+    server = create_webhook_server(env, bot)
+    stop_event = wait_for_stop_signal()
+    if server:
+        server.deliver = router.route
+        server.start()
+        stop_event.wait()
+        server.stop()
+    else:
+        bot.delete_webhook()
+        run_polling_router(bot, router, stop_event)
+
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+
+
+def run_worker(env, metrics_offset=0):
+    start_metrics(env, metrics_offset)
+    redis_db = create_redis(env)
+    slot_count = env.int('SHARD_SLOTS', SLOT_COUNT)
+    persistence = ShardedRedisPersistence(
+        redis_db,
+        States,
+        slot_count,
+        load_all=False,
+        flush_interval=env.float('PERSISTENCE_FLUSH_INTERVAL', 0.5),
+    )
+    updater, conv_handler = build_updater(env, redis_db, persistence, persistent=True)
+    dispatcher = updater.dispatcher
+    worker = ShardWorker(
+        redis_db,
+        dispatcher,
+        conv_handler,
+        slot_count=slot_count,
+        lease_ttl=env.int('SHARD_LEASE_TTL', 15),
+    )
+    stop_event = wait_for_stop_signal()
+    dispatcher.job_queue.start()
+    worker.run(stop_event)
+    dispatcher.job_queue.stop()
+    dispatcher.stop()
+    persistence.stop()
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    env = Env()
+    env.read_env()
+    roles = {
+        'single': run_single,
+        'router': run_router,
+        'worker': run_worker,
+    }
+    roles[env('BOT_ROLE', 'single')](env)
 
 
 if __name__ == '__main__':
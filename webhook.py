@@ -0,0 +1,120 @@
+import argparse
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from telegram import Update
+
+from json_stream import iter_records
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.webhook_path:
+            return self._respond(404)
+        secret = self.headers.get(SECRET_HEADER, '')
+        if server.secret_token and not hmac.compare_digest(secret, server.secret_token):
+            return self._respond(403)
+        length = int(self.headers.get('Content-Length', 0))
+        if not length or length > MAX_BODY_SIZE:
+            return self._respond(413 if length else 400)
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._respond(400)
+        server.deliver(payload)
+        self._respond(200)
+
+    def _respond(self, status):
+        if status != 200:
+            self.close_connection = True
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen='127.0.0.1', port=8443, path='/telegram', secret_token=None, deliver=None):
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.deliver = deliver
+        self.webhook_path = path
+        self.secret_token = secret_token
+        self._thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info('Webhook слушает %s:%s%s', *self.server_address[:2], self.webhook_path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def set_webhook(bot, url, secret_token=None, max_connections=40, drop_pending_updates=False):
+    api_kwargs = {'secret_token': secret_token} if secret_token else None
+    return bot.set_webhook(
+        url=url,
+        max_connections=max_connections,
+        drop_pending_updates=drop_pending_updates,
+        api_kwargs=api_kwargs,
+    )
+
+
+def run_webhook(updater, server):
+    dispatcher = updater.dispatcher
+    server.deliver = lambda payload: dispatcher.update_queue.put(Update.de_json(payload, updater.bot))
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    if dispatcher.job_queue:
+        dispatcher.job_queue.start()
+    server.start()
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    stop_event.wait()
+
+    server.stop()
+    if dispatcher.job_queue:
+        dispatcher.job_queue.stop()
+    dispatcher.stop()
+    if dispatcher.persistence:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+
+
+def replay_updates(file_path, url, secret_token=None):
+    session = requests.Session()
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    for update in iter_records(file_path):
+        response = session.post(url, json=update, headers=headers, timeout=10)
+        print(update.get('update_id'), response.status_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Отправить записанные обновления Telegram на webhook бота')
+    parser.add_argument('updates', help='файл с обновлениями(JSON-массив или NDJSON)')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram', help='адрес webhook')
+    parser.add_argument('--secret', help='секретный токен webhook')
+    args = parser.parse_args()
+    replay_updates(args.updates, args.url, args.secret)
+
+
+if __name__ == '__main__':
+    main()